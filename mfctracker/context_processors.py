@@ -24,11 +24,11 @@
 
 from django.conf import settings
 
-from .models import Branch
+from .registry import branch_registry
 
 def branches(request):
     # return the value you want as a dictionnary. you may add multiple values in there.
-    branches = Branch.maintenance().order_by('-branch_date', '-name')
+    branches = branch_registry.maintenance()
     return {'branches': branches}
 
 def ldap(request):
@@ -0,0 +1,150 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+from django.db import connection
+from django.db.models import Max
+
+from mfctracker.models import Commit
+
+class _UnionFind(object):
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, key):
+        root = self.parent.setdefault(key, key)
+        while root != self.parent[root]:
+            root = self.parent[root]
+        # Path compression
+        while key != root:
+            self.parent[key], key = root, self.parent[key]
+        return root
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+def connected_components(pairs, groups, next_group):
+    """Merge X-MFC-With edges into dependency groups.
+
+       pairs are (sha, sha) edges, groups maps SHAs of all commits in
+       pairs to their current group id or None and next_group is the
+       first unused group id. Connected groups are merged into the one
+       with the smallest id. Returns tuple of dict of SHAs whose group
+       changes to new group id and dict mapping merged group ids to
+       the group they are merged into.
+    """
+    uf = _UnionFind()
+    for a, b in pairs:
+        uf.union(('commit', a), ('commit', b))
+    for sha, group in groups.items():
+        uf.find(('commit', sha))
+        if group is not None:
+            uf.union(('commit', sha), ('group', group))
+
+    components = {}
+    for key in list(uf.parent.keys()):
+        components.setdefault(uf.find(key), []).append(key)
+
+    assign = {}
+    renames = {}
+    for keys in components.values():
+        existing = sorted(value for kind, value in keys if kind == 'group')
+        if existing:
+            target = existing[0]
+        else:
+            target = next_group
+            next_group += 1
+        for group in existing[1:]:
+            renames[group] = target
+        for kind, value in keys:
+            if kind == 'commit' and groups.get(value, None) != target:
+                assign[value] = target
+
+    return assign, renames
+
+def merge_dependency_groups(pairs):
+    """Update Commit.dependency_group for new X-MFC-With edges, commits
+       must be in the database already. Caller is expected to hold the
+       trunk import lock so group ids are not allocated concurrently.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+
+    shas = set()
+    for a, b in pairs:
+        shas.add(a)
+        shas.add(b)
+    groups = dict(Commit.objects.filter(sha__in=shas).values_list('sha', 'dependency_group'))
+    next_group = (Commit.objects.aggregate(Max('dependency_group'))['dependency_group__max'] or 0) + 1
+    assign, renames = connected_components(pairs, groups, next_group)
+
+    for old, new in renames.items():
+        Commit.objects.filter(dependency_group=old).update(dependency_group=new)
+    by_group = {}
+    for sha, group in assign.items():
+        by_group.setdefault(group, []).append(sha)
+    for group, group_shas in by_group.items():
+        Commit.objects.filter(sha__in=group_shas).update(dependency_group=group)
+
+# Walks X-MFC-With graph from the given commits. Expansion stops at
+# commits merged to the branch and at commits that are in the set
+# themselves, those are checked as origins on their own
+MISSING_DEPENDENCIES_SQL = '''
+WITH RECURSIVE deps(origin, sha) AS (
+    SELECT m.from_commit_id, m.to_commit_id
+    FROM {mfc_with} m
+    WHERE m.from_commit_id = ANY(%(shas)s)
+  UNION
+    SELECT d.origin, m.to_commit_id
+    FROM deps d JOIN {mfc_with} m ON m.from_commit_id = d.sha
+    WHERE NOT d.sha = ANY(%(shas)s)
+      AND NOT EXISTS (SELECT 1 FROM {merged_to} t WHERE t.commit_id = d.sha AND t.branch_id = %(branch)s)
+)
+SELECT d.origin, d.sha FROM deps d
+WHERE d.sha <> d.origin
+  AND NOT d.sha = ANY(%(shas)s)
+  AND NOT EXISTS (SELECT 1 FROM {merged_to} t WHERE t.commit_id = d.sha AND t.branch_id = %(branch)s)
+'''
+
+def missing_dependencies(shas, branch):
+    """Find direct and transitive X-MFC-With dependencies of commits
+       that are neither in shas nor merged to the branch, in one query.
+       Returns dict mapping SHA to set of missing dependency SHAs.
+    """
+    shas = list(set(shas))
+    if not shas:
+        return {}
+
+    sql = MISSING_DEPENDENCIES_SQL.format(
+        mfc_with=Commit.mfc_with.through._meta.db_table,
+        merged_to=Commit.merged_to.through._meta.db_table)
+    missing = {}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'shas': shas, 'branch': branch.pk})
+        for origin, sha in cursor.fetchall():
+            missing.setdefault(origin, set()).add(sha)
+    return missing
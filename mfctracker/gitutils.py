@@ -0,0 +1,195 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+from collections import namedtuple
+
+from git.exc import GitCommandError
+
+from mfctracker.utils import get_svn_revision
+
+# Batches up to this size look notes up by path in the notes tree
+# instead of listing all notes
+NOTES_LOOKUP_LIMIT = 256
+
+class NotesReader(object):
+    """Resolve SVN revisions recorded in git notes for batches of commits.
+
+       Small batches, like the few new commits a sync run imports, look
+       up note paths in the notes tree through GitPython's persistent
+       `git cat-file --batch-check` process. Larger batches read the
+       notes map with a single `git notes list` run, which is reused for
+       every following batch. Note blobs are read through the persistent
+       `git cat-file --batch` process, so the number of spawned git
+       processes does not depend on the number of commits or batches.
+       Create new reader to see notes added after the map was read.
+    """
+
+    def __init__(self, repo, notes_ref='refs/notes/commits', lookup_limit=NOTES_LOOKUP_LIMIT):
+        self.repo = repo
+        self.notes_ref = notes_ref
+        self.lookup_limit = lookup_limit
+        self._notes = None
+        self._fanout = 0
+
+    def _list_notes(self):
+        """Return dictionary mapping commit SHA to note blob SHA
+           for every commit that has a note attached
+        """
+        if self._notes is None:
+            notes = {}
+            proc = self.repo.git.notes('--ref', self.notes_ref, 'list', as_process=True)
+            for line in proc.stdout:
+                parts = line.decode('ascii').split()
+                if len(parts) != 2:
+                    continue
+                blob_sha, commit_sha = parts
+                notes[commit_sha] = blob_sha
+            proc.wait()
+            self._notes = notes
+        return self._notes
+
+    def _lookup_note(self, sha):
+        """Return note blob SHA for the commit or None. Notes tree splits
+           paths into two-digit directories once it grows, try the depth
+           that worked last time first.
+        """
+        depths = [self._fanout] + [depth for depth in range(4) if depth != self._fanout]
+        for depth in depths:
+            path = '/'.join([sha[i * 2:i * 2 + 2] for i in range(depth)] + [sha[depth * 2:]])
+            try:
+                blob_sha, typename, size = self.repo.git.get_object_header('{}:{}'.format(self.notes_ref, path))
+            except ValueError:
+                continue
+            self._fanout = depth
+            return blob_sha.decode('ascii')
+        return None
+
+    def _read_note(self, blob_sha):
+        hexsha, typename, size, data = self.repo.git.get_object_data(blob_sha)
+        return data.decode('utf-8', 'replace')
+
+    def _show_note(self, sha):
+        try:
+            return self.repo.git.notes('--ref', self.notes_ref, 'show', sha)
+        except GitCommandError:
+            return None
+
+    def revisions(self, shas):
+        """Return dictionary mapping commit SHA to SVN revision
+           for every commit in shas that has one
+        """
+        shas = set(shas)
+        if not shas:
+            return {}
+
+        try:
+            if self._notes is None and len(shas) <= self.lookup_limit:
+                notes = {}
+                for sha in shas:
+                    blob_sha = self._lookup_note(sha)
+                    if blob_sha is not None:
+                        notes[sha] = blob_sha
+            else:
+                all_notes = self._list_notes()
+                notes = dict((sha, all_notes[sha]) for sha in shas if sha in all_notes)
+        except GitCommandError:
+            # Fall back to one lookup per commit
+            notes = dict.fromkeys(shas)
+
+        result = {}
+        for sha, blob_sha in notes.items():
+            text = None
+            if blob_sha is not None:
+                try:
+                    text = self._read_note(blob_sha)
+                except (GitCommandError, ValueError):
+                    pass
+            if text is None:
+                text = self._show_note(sha)
+            if text is None:
+                continue
+            revision = get_svn_revision(text)
+            if revision is not None:
+                result[sha] = revision
+
+        return result
+
+
+LogEntry = namedtuple('LogEntry', ['sha', 'committed_date', 'committer_email', 'message', 'paths'])
+
+def is_ancestor(repo, ancestor, ref):
+    """Check that commit ancestor exists and is reachable from ref"""
+    try:
+        repo.git.merge_base('--is-ancestor', ancestor, ref)
+        return True
+    except GitCommandError:
+        return False
+
+def iter_log(repo, rev_range, with_paths=False, chunk_size=65536):
+    """Yield LogEntry for every commit in rev_range in chronological
+       order. The log is read from a single git log invocation and
+       parsed as a stream, so memory use does not depend on the size of
+       the range. With with_paths set, entries also have list of changed
+       paths, merge commits are diffed against their first parent
+       (requires git 2.31 or newer).
+    """
+    args = [rev_range, '--reverse', '-z', '--format=%x01%H%x1f%ct%x1f%ce%x1f%B']
+    if with_paths:
+        args += ['--name-only', '--no-renames', '--diff-merges=first-parent']
+    proc = repo.git.log(*args, as_process=True)
+
+    header = None
+    paths = []
+    tail = b''
+    finished = False
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            tokens = (tail + chunk).split(b'\0')
+            # Keep incomplete token for the next chunk unless it's EOF
+            tail = tokens.pop() if chunk else b''
+            for token in tokens:
+                if token.startswith(b'\x01'):
+                    if header is not None:
+                        yield LogEntry(*header, paths=paths)
+                    sha, committed_date, email, message = token[1:].decode('utf-8', 'replace').split('\x1f', 3)
+                    header = (sha, int(committed_date), email, message)
+                    paths = []
+                else:
+                    token = token.lstrip(b'\n')
+                    if token:
+                        paths.append(token.decode('utf-8', 'surrogateescape'))
+            if not chunk:
+                break
+        if header is not None:
+            yield LogEntry(*header, paths=paths)
+        finished = True
+        proc.wait()
+    finally:
+        if not finished:
+            # git is killed by SIGPIPE if the consumer stopped early
+            proc.stdout.close()
+            try:
+                proc.wait()
+            except GitCommandError:
+                pass
@@ -0,0 +1,214 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.contrib.postgres.search import SearchVector
+from django.db.models import Q
+
+from mfctracker.models import SEARCH_CONFIG, Commit, Change, Path
+from mfctracker.pagecache import invalidate_imports
+
+# First key of two-key PostgreSQL advisory locks taken by the importer,
+# the second one is the branch id
+IMPORT_LOCK_NAMESPACE = 0x4d4643
+
+@contextmanager
+def branch_lock(branch, shared=False, wait=True):
+    """Hold session-level PostgreSQL advisory lock for the branch import.
+       With wait=False yields False instead of blocking if the lock is
+       held by someone else. Other database backends have no locking.
+    """
+    if connection.vendor != 'postgresql':
+        yield True
+        return
+
+    suffix = '_shared' if shared else ''
+    args = [IMPORT_LOCK_NAMESPACE, branch.pk]
+    with connection.cursor() as cursor:
+        if wait:
+            cursor.execute('SELECT pg_advisory_lock{}(%s, %s)'.format(suffix), args)
+            acquired = True
+        else:
+            cursor.execute('SELECT pg_try_advisory_lock{}(%s, %s)'.format(suffix), args)
+            acquired = cursor.fetchone()[0]
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock{}(%s, %s)'.format(suffix), args)
+
+
+class CommitWriter(object):
+    """Accumulate imported commits, their changes and M2M relations
+       and write them to the database with bulk inserts, one
+       transaction per flush
+    """
+
+    def __init__(self, batch_size=1000, log=None):
+        self.batch_size = batch_size
+        self.log = log
+        self.commits = []
+        self.changes = []
+        self.relations = OrderedDict()
+
+    def add_commit(self, commit, paths=()):
+        self.commits.append(commit)
+        for path in paths:
+            self.changes.append((commit, path))
+
+    def add_relation(self, through, **kwargs):
+        """Queue row for M2M through model, duplicates are ignored"""
+        rows = self.relations.setdefault(through, OrderedDict())
+        key = tuple(sorted(kwargs.items()))
+        if not key in rows:
+            rows[key] = through(**kwargs)
+
+    def pending(self):
+        return len(self.commits) + len(self.changes) + \
+            sum(len(rows) for rows in self.relations.values())
+
+    def flush(self, checkpoint=None):
+        """Write all pending rows in one transaction. If checkpoint branch
+           is passed its last_commit is saved in the same transaction.
+        """
+        rows = self.pending()
+        if not rows and checkpoint is None:
+            return 0
+
+        start = time.time()
+        with transaction.atomic():
+            Commit.objects.bulk_create(self.commits, batch_size=self.batch_size)
+            if self.commits:
+                # Search vectors are computed by the database
+                shas = [commit.sha for commit in self.commits]
+                Commit.objects.filter(sha__in=shas).update(msg_search=SearchVector('msg', config=SEARCH_CONFIG))
+            path_ids = Path.ids(path for commit, path in self.changes)
+            changes = [Change(path_id=path_ids[path], commit=commit) for commit, path in self.changes]
+            Change.objects.bulk_create(changes, batch_size=self.batch_size)
+            for through, relations in self.relations.items():
+                through.objects.bulk_create(list(relations.values()), batch_size=self.batch_size)
+            if checkpoint is not None:
+                checkpoint.save(update_fields=['last_commit'])
+            if rows:
+                invalidate_imports()
+        elapsed = time.time() - start
+
+        if self.log:
+            rate = rows / elapsed if elapsed > 0 else rows
+            self.log('Flushed {} commits, {} rows in {:.2f}s ({:.0f} rows/sec)'.format(
+                len(self.commits), rows, elapsed, rate))
+
+        self.commits = []
+        self.changes = []
+        self.relations = OrderedDict()
+        return rows
+
+
+def resolve_mfc_with(mfc_with, pending=(), chunk_size=500):
+    """Resolve X-MFC-With entries for a batch of commits.
+
+       mfc_with maps commit SHA to set of SVN revisions or SHA prefixes.
+       All revisions are resolved with one query and all prefixes with
+       one query per chunk_size prefixes. Commits in pending are not in
+       the database yet but can be dependencies too. Returns tuple of
+       list of (sha, dependency_sha) pairs and list of error messages.
+    """
+    revisions = set()
+    prefixes = set()
+    for deps in mfc_with.values():
+        for dep in deps:
+            try:
+                revisions.add(int(dep))
+            except ValueError:
+                prefixes.add(dep.lower())
+
+    by_revision = {}
+    if revisions:
+        by_revision = dict(Commit.objects.filter(svn_revision__in=revisions).values_list('svn_revision', 'sha'))
+    found = set()
+    for commit in pending:
+        if commit.svn_revision is not None:
+            by_revision[commit.svn_revision] = commit.sha
+        found.add(commit.sha)
+
+    prefixes = sorted(prefixes)
+    for i in range(0, len(prefixes), chunk_size):
+        q = Q()
+        for prefix in prefixes[i:i + chunk_size]:
+            q |= Q(sha__startswith=prefix)
+        found.update(Commit.objects.filter(q).values_list('sha', flat=True))
+    found = sorted(found)
+
+    pairs = []
+    errors = []
+    for sha, deps in mfc_with.items():
+        for dep in deps:
+            try:
+                rev = int(dep)
+                if rev in by_revision:
+                    pairs.append((sha, by_revision[rev]))
+                else:
+                    errors.append('{} has r{} in X-MFC-With list but it does not exist'.format(sha, dep))
+                continue
+            except ValueError:
+                pass
+
+            prefix = dep.lower()
+            matches = []
+            pos = bisect_left(found, prefix)
+            while pos < len(found) and found[pos].startswith(prefix):
+                matches.append(found[pos])
+                pos += 1
+
+            if len(matches) == 0:
+                errors.append('{} has {} in X-MFC-With list but it does not exist'.format(sha, dep))
+            elif len(matches) > 1:
+                errors.append('{} has {} in X-MFC-With list but it is ambiguous'.format(sha, dep))
+            else:
+                pairs.append((sha, matches[0]))
+
+    return pairs, errors
+
+
+def merged_to_delta(branch, shas, chunk_size=1000):
+    """Diff set of commits merged to the branch against existing
+       merged_to rows. Returns tuple of set of SHAs that are not
+       recorded as merged yet and set of SHAs that do not exist.
+    """
+    shas = sorted(set(shas))
+    through = Commit.merged_to.through
+    existing = set()
+    merged = set()
+    for i in range(0, len(shas), chunk_size):
+        chunk = shas[i:i + chunk_size]
+        existing.update(Commit.objects.filter(sha__in=chunk).values_list('sha', flat=True))
+        merged.update(through.objects.filter(branch_id=branch.pk, commit_id__in=chunk).values_list('commit_id', flat=True))
+
+    return existing - merged, set(shas) - existing
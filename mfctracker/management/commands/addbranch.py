@@ -28,6 +28,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 
+from mfctracker.mfcstatus import refresh_status
 from mfctracker.models import Branch
 
 class Command(BaseCommand):
@@ -74,5 +75,8 @@ class Command(BaseCommand):
         try:
             branch.save()
             self.stdout.write(self.style.SUCCESS('Branch {} created with path {}, branch point: {}'.format(name, path, branchpoint)))
+            if not trunk:
+                rows = refresh_status(branch)
+                self.stdout.write('Added MFC status for {} trunk commits'.format(rows))
         except Exception as e:
             raise CommandError('Error adding new branch: {}'.format(e.message))
@@ -22,22 +22,23 @@
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
 from git import Repo
-from git.exc import GitCommandError
-import json
-import parsedatetime
-import time
-import re
-from datetime import date, datetime, timezone
-from collections import deque
-
-from django.core.management.base import BaseCommand, CommandError
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+
+from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.db.models import Max
-from django.utils.crypto import get_random_string
 
-from mfctracker.models import Commit, Branch, Change
-from mfctracker.utils import get_mfc_requirements, get_cherry_picked_commits
+from mfctracker.gitutils import NotesReader, is_ancestor, iter_log
+from mfctracker.dependencies import merge_dependency_groups
+from mfctracker.importer import CommitWriter, branch_lock, merged_to_delta, resolve_mfc_with
+from mfctracker.mfcstatus import refresh_status, refresh_trunk_commits
+from mfctracker.models import Commit, Branch
+from mfctracker.users import provision_users
+from mfctracker.utils import batches, parse_commit_metadata
 
 class Command(BaseCommand):
     help = 'Import new commits from SVN repo'
@@ -49,142 +50,170 @@ class Command(BaseCommand):
             default=None, help='name of the branch')
         parser.add_argument('-l', '--limit', type=int,
             default=None, help='maximum number of commits passsed to git log command')
+        parser.add_argument('--batch-size', type=int,
+            default=1000, help='number of commits written to the database in one transaction')
+        parser.add_argument('-j', '--jobs', type=int,
+            default=1, help='number of stable branches imported concurrently')
 
     def handle(self, *args, **options):
-        start_revision = options['start_revision']
         branch = options['branch']
-        limit = options['limit']
-        committers = {}
+        jobs = options['jobs']
 
         if branch is None:
             branches = list(Branch.objects.all().order_by('-is_trunk'))
         else:
             branches = [ Branch.objects.get(name=branch) ]
 
-        repo = Repo(settings.GIT_REPO)
+        try:
+            trunk = Branch.trunk()
+        except Branch.DoesNotExist:
+            trunk = None
 
+        # Trunk commits have to be in the database before cherry-picks
+        # on stable branches are resolved
         for b in branches:
-            commits = b.commits.all()
-            counter = commits.aggregate(Max('commit_counter'))['commit_counter__max']
-            if counter is None:
-                counter = 1
-            else:
-                counter = counter + 1
-            branch_ref = 'remotes/origin/' + b.path
-            if not start_revision:
-                revision = b.last_commit
-            else:
-                revision = start_revision
-            self.stdout.write('Importing commits for branch %s, starting with %s (last revision %s)' % (b.name, revision, b.last_commit))
-            log_entries = repo.iter_commits(branch_ref)
-            branch_commits = 0
-            last_commit = ''
+            if b.is_trunk:
+                self.import_branch_locked(b, None, options)
+
+        stable_branches = [b for b in branches if not b.is_trunk]
+        if jobs > 1 and len(stable_branches) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(self.import_branch_job, b, trunk, options) for b in stable_branches]
+                for future in futures:
+                    future.result()
+        else:
+            for b in stable_branches:
+                self.import_branch_locked(b, trunk, options)
+
+    def import_branch_job(self, b, trunk, options):
+        try:
+            self.import_branch_locked(b, trunk, options)
+        finally:
+            # Every worker thread has its own database connection
+            connection.close()
+
+    def import_branch_locked(self, b, trunk, options, repo=None):
+        """Import branch holding its advisory lock. Stable branches also
+           wait for trunk import running in other process to finish.
+           Returns number of imported commits or None if the stable
+           branch is locked by another process. Trunk import always
+           waits for the lock since stable imports in other processes
+           hold it shared.
+        """
+        with ExitStack() as stack:
+            if trunk is not None:
+                stack.enter_context(branch_lock(trunk, shared=True))
+            acquired = stack.enter_context(branch_lock(b, wait=b.is_trunk))
+            if not acquired:
+                self.stdout.write('Branch {} is being imported by another process, skipping'.format(b.name))
+                return None
+            # last_commit may have been advanced while we were waiting
+            b.refresh_from_db()
+            return self.import_branch(b, options, repo)
+
+    def import_branch(self, b, options, repo=None):
+        """Import new commits of the branch, returns number of imported
+           commits. repo may be passed to reuse its git processes.
+        """
+        start_revision = options['start_revision']
+        limit = options['limit']
+        batch_size = options['batch_size']
+
+        if repo is None:
+            repo = Repo(settings.GIT_REPO)
+        notes_reader = NotesReader(repo)
+        writer = CommitWriter(batch_size, log=self.stdout.write)
+
+        commits = b.commits.all()
+        counter = commits.aggregate(Max('commit_counter'))['commit_counter__max']
+        if counter is None:
+            counter = 1
+        else:
+            counter = counter + 1
+        branch_ref = 'remotes/origin/' + b.path
+        if not start_revision:
+            revision = b.last_commit
+        else:
+            revision = start_revision
+        self.stdout.write('Importing commits for branch %s, starting with %s (last revision %s)' % (b.name, revision, b.last_commit))
+        branch_commits = 0
+        last_commit = ''
+
+        if not is_ancestor(repo, b.last_commit, branch_ref):
+            self.stdout.write(self.style.ERROR('Last imported commit {} is not reachable from {}, skipping branch {}'.format(b.last_commit, branch_ref, b.name)))
+            return 0
+
+        log_entries = iter_log(repo, '{}..{}'.format(b.last_commit, branch_ref), with_paths=b.is_trunk)
+        if limit is not None:
+            log_entries = islice(log_entries, limit)
+
+        for batch in batches(log_entries, batch_size):
+            revisions = notes_reader.revisions([entry.sha for entry in batch])
+            committers = set()
             mfc_with = {}
             mfced = set()
-            # track back to the last commit
-
-            new_entries = deque([], limit)
-            for entry in log_entries:
-                if entry.hexsha == b.last_commit:
-                    break
-                new_entries.appendleft(entry)
 
-            for entry in new_entries:
+            for entry in batch:
                 committed_date = datetime.fromtimestamp(entry.committed_date, tz=timezone.utc)
-                revision = None
-                try:
-                    notes = repo.git.notes('show', entry.hexsha)
-                    m = re.match('.*revision=(\d+).*', notes)
-                    if m:
-                        revision = m.group(1)
-                except GitCommandError:
-                    pass
-                author = entry.committer.email
+                revision = revisions.get(entry.sha, None)
+                author = entry.committer_email
                 if author.find('@') >= 0:
                     author = author.split("@")[0]
 
-                commit = Commit.create(entry.hexsha, author, committed_date, entry.message)
+                metadata = parse_commit_metadata(entry.message, committed_date)
+                for error in metadata.errors:
+                    self.stdout.write(self.style.ERROR(error))
+
+                commit = Commit.create(entry.sha, author, committed_date, entry.message)
                 commit.branch = b
                 commit.svn_revision = revision
-                commit.mfc_after = self.parse_mfc_entry(entry.message, committed_date);
+                commit.mfc_after = metadata.mfc_after
                 commit.commit_counter = counter
                 counter += 1
-                commit.save()
-
-                if b.is_trunk:
-                    changes = []
-                    for path in entry.stats.files:
-                        change = Change(path=path, commit=commit)
-                        changes.append(change)
-                    Change.objects.bulk_create(changes)
+                writer.add_commit(commit, entry.paths)
 
                 branch_commits += 1
-                last_commit = entry.hexsha
+                last_commit = entry.sha
                 if b.is_trunk:
-                    deps = get_mfc_requirements(entry.message)
-                    if len(deps) > 0:
-                        mfc_with[entry.hexsha] = deps
+                    if len(metadata.mfc_with) > 0:
+                        mfc_with[entry.sha] = metadata.mfc_with
                 else:
-                    picked = get_cherry_picked_commits(entry.message)
-                    mfced = mfced.union(picked)
-
-                if not entry.author in committers:
-                    try:
-                        user = User.objects.get(username=entry.author)
-                    except User.DoesNotExist:
-                        email = '{}@{}'.format(entry.author, settings.SVN_EMAIL_DOMAIN)
-                        password = get_random_string(length=32)
-                        user = User.objects.create_user(entry.author, email, password)
-                    committers[entry.author] = user
-
-            for sha in mfced:
-                try:
-                    commit = Commit.objects.get(sha=sha)
-                    commit.merged_to.add(b)
-                    commit.save()
-                except Commit.DoesNotExist:
-                    self.stdout.write(self.style.ERROR('{} merked as merged but does not exist'.format(sha)))
-
-            for sha, deps in mfc_with.items():
-                commit = Commit.objects.get(sha=sha)
-                for dep in deps:
-                    try:
-                        rev = int(dep)
-                        dep_commit = Commit.objects.get(svn_revision=rev)
-                        commit.mfc_with.add(dep_commit)
-                        continue
-                    except Commit.DoesNotExist:
-                        self.stdout.write(self.style.ERROR('{} has r{} in X-MFC-With list but it does not exist'.format(sha, dep)))
-                        continue
-                    except ValueError:
-                        pass
-
-                    dep_commits = Commit.objects.filter(sha__startswith=dep)
-                    if dep_commits.count() == 0:
-                        self.stdout.write(self.style.ERROR('{} has {} in X-MFC-With list but it does not exist'.format(sha, dep)))
-                    elif dep_commits.count() > 1:
-                        self.stdout.write(self.style.ERROR('{} has {} in X-MFC-With list but it is ambiguous'.format(sha, dep)))
-                    else:
-                        commit.mfc_with.add(dep_commits[0])
-
-            if branch_commits:
-                self.stdout.write('Imported {} commits, last revision is {}'.format(branch_commits, last_commit))
-                b.last_commit = last_commit
-            else:
-                self.stdout.write('No commits to import')
-
-            b.save()
-
-    def parse_mfc_entry(self, msg, commit_date):
-        lines = msg.split('\n')
-        for line in lines:
-            if re.match('^\s*mfc(-|\s+)after\s*:', line, flags=re.IGNORECASE):
-                calendar = parsedatetime.Calendar()
-                mfc_after_st, parsed = calendar.parse(line, commit_date)
-                if parsed:
-                    mfc_after = date.fromtimestamp(time.mktime(mfc_after_st))
-                    return mfc_after
+                    mfced |= metadata.cherry_picked
+
+                committers.add(author)
+
+            for username in provision_users(committers):
+                self.stdout.write('Added user {}'.format(username))
+
+            merged, missing = merged_to_delta(b, mfced)
+            for sha in sorted(missing):
+                self.stdout.write(self.style.ERROR('{} marked as merged but does not exist'.format(sha)))
+            for sha in merged:
+                writer.add_relation(Commit.merged_to.through, commit_id=sha, branch_id=b.pk)
+
+            # Dependencies may be in this batch that is not in the database yet
+            through = Commit.mfc_with.through
+            pairs, errors = resolve_mfc_with(mfc_with, pending=writer.commits)
+            for error in errors:
+                self.stdout.write(self.style.ERROR(error))
+            for sha, dep_sha in pairs:
+                writer.add_relation(through, from_commit_id=sha, to_commit_id=dep_sha)
+                writer.add_relation(through, from_commit_id=dep_sha, to_commit_id=sha)
+
+            # Branch watermark is advanced in the same transaction as
+            # the batch, so interrupted import resumes right after it
+            b.last_commit = last_commit
+            with transaction.atomic():
+                writer.flush(checkpoint=b)
+                if b.is_trunk:
+                    refresh_trunk_commits([entry.sha for entry in batch])
+                    merge_dependency_groups(pairs)
                 else:
-                    self.stdout.write(self.style.ERROR(u'Failed to parse MFC line: \'' + line + u'\''))
+                    refresh_status(b, merged)
+
+        if branch_commits:
+            self.stdout.write('Imported {} commits, last revision is {}'.format(branch_commits, last_commit))
+        else:
+            self.stdout.write('No commits to import')
 
-        return None
+        return branch_commits
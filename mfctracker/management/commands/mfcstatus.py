@@ -0,0 +1,53 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+from django.core.management.base import BaseCommand, CommandError
+
+from mfctracker.mfcstatus import advance_status, refresh_status
+from mfctracker.models import Branch
+
+class Command(BaseCommand):
+    help = 'Update MFC status of trunk commits, should be run daily unless syncd is running'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--rebuild', action='store_true',
+            help='recompute status of all commits instead of daily update')
+        parser.add_argument('-b', '--branch', type=str,
+            help='branch to rebuild status for (default: all maintenance branches)')
+
+    def handle(self, *args, **options):
+        if not options['rebuild']:
+            updated = advance_status()
+            self.stdout.write('{} commits are ready for MFC'.format(updated))
+            return
+
+        if options['branch']:
+            branches = Branch.maintenance().filter(name=options['branch'])
+            if not branches:
+                raise CommandError('Maintenance branch {} does not exist'.format(options['branch']))
+        else:
+            branches = Branch.maintenance()
+
+        for b in branches:
+            rows = refresh_status(b)
+            self.stdout.write('Branch {}: status of {} commits rebuilt'.format(b.name, rows))
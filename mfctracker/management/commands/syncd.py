@@ -0,0 +1,146 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+import json
+import os
+import signal
+import threading
+import time
+from datetime import date, datetime, timezone
+
+from git import Repo
+from git.exc import GitCommandError
+
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections
+
+from mfctracker.management.commands.importcommits import Command as ImportCommand
+from mfctracker.mfcstatus import advance_status
+from mfctracker.models import Branch
+
+class Command(BaseCommand):
+    help = 'Stay resident and import commits for branches whose refs moved'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--interval', type=int,
+            default=30, help='seconds between checks for new commits')
+        parser.add_argument('--no-fetch', dest='fetch', action='store_false',
+            help='do not run git fetch, only watch local refs')
+        parser.add_argument('--status-file', type=str,
+            default='/var/tmp/mfctracker.syncd.json', help='file to write last run status to')
+        parser.add_argument('--batch-size', type=int,
+            default=1000, help='number of commits written to the database in one transaction')
+        parser.add_argument('--once', action='store_true',
+            help='run one check and exit')
+
+    def handle(self, *args, **options):
+        self.stopped = threading.Event()
+        self.status_date = None
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stopped.set())
+
+        # Repo is kept between runs so its persistent git cat-file
+        # processes stay warm
+        repo = Repo(settings.GIT_REPO)
+        importer = ImportCommand(stdout=self.stdout, stderr=self.stderr)
+        import_options = {
+            'start_revision': '',
+            'limit': None,
+            'batch_size': options['batch_size'],
+        }
+
+        while not self.stopped.is_set():
+            started = time.time()
+            # Drop connections that are broken or over CONN_MAX_AGE,
+            # live ones are reused between runs
+            close_old_connections()
+            try:
+                status = self.sync(repo, importer, import_options, options['fetch'])
+            except Exception as e:
+                status = {'error': str(e), 'branches': {}}
+                self.stdout.write(self.style.ERROR('Sync failed: {}'.format(e)))
+            status['started'] = datetime.fromtimestamp(started, tz=timezone.utc).isoformat()
+            status['duration'] = round(time.time() - started, 3)
+            self.write_status(options['status_file'], status)
+            if options['once']:
+                break
+            self.stopped.wait(options['interval'])
+
+    def sync(self, repo, importer, import_options, fetch):
+        """Fetch and import every branch whose remote ref differs from
+           the last imported commit. Returns status dictionary.
+        """
+        status = {'error': None, 'branches': {}}
+        if fetch:
+            try:
+                repo.git.fetch()
+            except GitCommandError as e:
+                status['error'] = 'git fetch failed: {}'.format(e)
+                self.stdout.write(self.style.ERROR(status['error']))
+
+        refs = self.remote_refs(repo)
+        branches = list(Branch.objects.all().order_by('-is_trunk'))
+        trunk = None
+        for b in branches:
+            if b.is_trunk:
+                trunk = b
+
+        for b in branches:
+            tip = refs.get(b.path, None)
+            branch_status = {'tip': tip, 'last_commit': b.last_commit, 'imported': 0}
+            status['branches'][b.name] = branch_status
+            if tip is None or tip == b.last_commit:
+                continue
+            imported = importer.import_branch_locked(b, None if b.is_trunk else trunk, import_options, repo)
+            if imported is None:
+                branch_status['locked'] = True
+            else:
+                branch_status['imported'] = imported
+            branch_status['last_commit'] = b.last_commit
+
+        # Waiting commits become ready once a day
+        today = date.today()
+        if today != self.status_date:
+            status['ready'] = advance_status(today)
+            self.status_date = today
+
+        return status
+
+    def remote_refs(self, repo):
+        """Map branch path to the SHA of remotes/origin/<path>"""
+        prefix = 'refs/remotes/origin/'
+        refs = {}
+        output = repo.git.for_each_ref('--format=%(objectname) %(refname)', prefix)
+        for line in output.splitlines():
+            sha, name = line.split(' ', 1)
+            refs[name[len(prefix):]] = sha
+        return refs
+
+    def write_status(self, path, status):
+        if not path:
+            return
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
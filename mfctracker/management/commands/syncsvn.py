@@ -21,35 +21,125 @@
 #  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
+import hashlib
+import sys
+import svn.common
 import svn.remote
-import json
-import parsedatetime
-import time
-import re
-from datetime import date, datetime, timedelta
-from collections import deque
-
-from django.core.management.base import BaseCommand, CommandError
+
+from django.core.management.base import BaseCommand
 from django.conf import settings
-from django.contrib.auth.models import User
-from django.utils.crypto import get_random_string
+from django.db import transaction
+from django.db.models import Max, Q
 
-from mfctracker.models import Commit, Branch, Change
-from mfctracker.utils import get_mfc_requirements, mergeinfo_ranges_to_set, parse_mergeinfo_prop
+from mfctracker.importer import CommitWriter, branch_lock, merged_to_delta
+from mfctracker.mfcstatus import refresh_status
+from mfctracker.models import Commit, Branch, MergeinfoSnapshot
+from mfctracker.utils import IntervalSet, batches, parse_mergeinfo_prop
 
 class Command(BaseCommand):
-    help = 'Import new commits from SVN repo'
+    help = 'Mark commits merged according to svn:mergeinfo of the branches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--branch', type=str,
+            default=None, help='name of the branch, all maintenance branches by default')
+        parser.add_argument('-s', '--source', type=str,
+            default='/head', help='SVN path commits were merged from')
+        parser.add_argument('-u', '--url', type=str,
+            default=settings.SVN_BASE_URL, help='SVN repository URL')
+        parser.add_argument('-f', '--full', action='store_true',
+            help='ignore the last processed svn:mergeinfo and apply all ranges')
+        parser.add_argument('--chunk-size', type=int,
+            default=100, help='number of revision ranges per query')
 
     def handle(self, *args, **options):
-        r = svn.remote.RemoteClient(settings.SVN_BASE_URL)
-        b = Branch.objects.get(name='STABLE-12')
-        props = r.properties(b.path)
-        mergeinfo_prop = props.get('svn:mergeinfo', None)
-        mergeinfo = parse_mergeinfo_prop(props['svn:mergeinfo'])
-        update_revisions = mergeinfo_ranges_to_set(mergeinfo['/head'])
-        for commit in Commit.objects.filter(svn_revision__in=update_revisions):
-            print (commit.svn_revision)
-            commit.merged_to.add(b)
-            commit.save()
-
-        return None
+        branch = options['branch']
+
+        if branch is None:
+            branches = list(Branch.maintenance().order_by('name'))
+        else:
+            branches = [ Branch.objects.get(name=branch) ]
+
+        client = svn.remote.RemoteClient(options['url'])
+        self.sync_branches(client, branches, options['source'], options['full'], options['chunk_size'])
+
+    def sync_branches(self, client, branches, source, full=False, chunk_size=100):
+        """Sync every branch holding its import lock. Branches that svn
+           fails on (e.g. git-only stable branches) are reported and
+           skipped. Returns list of names of failed branches.
+        """
+        failed = []
+        for b in branches:
+            try:
+                with branch_lock(b):
+                    self.sync_mergeinfo(client, b, source, full, chunk_size)
+            except svn.common.SvnException as e:
+                failed.append(b.name)
+                self.stdout.write(self.style.ERROR('Branch {}: svn failed: {}'.format(b.name, e)))
+        return failed
+
+    def sync_mergeinfo(self, client, b, source, full=False, chunk_size=100):
+        """Apply ranges merged from source to the branch since the last
+           run. client is anything with svn.remote.RemoteClient's info()
+           and properties() methods. Returns number of commits marked
+           as merged.
+        """
+        snapshot, created = MergeinfoSnapshot.objects.get_or_create(branch=b, source=source)
+        if full:
+            snapshot.last_changed_revision = None
+            snapshot.digest = ''
+            snapshot.merged = ''
+
+        last_changed_revision = client.info(b.path)['commit_revision']
+        if last_changed_revision == snapshot.last_changed_revision:
+            self.stdout.write('Branch {}: not changed since r{}'.format(b.name, last_changed_revision))
+            return 0
+
+        props = client.properties(b.path)
+        mergeinfo_prop = props.get('svn:mergeinfo', None) or ''
+        digest = hashlib.sha256(mergeinfo_prop.encode('utf-8')).hexdigest()
+        if digest == snapshot.digest:
+            snapshot.last_changed_revision = last_changed_revision
+            snapshot.save()
+            self.stdout.write('Branch {}: svn:mergeinfo not changed'.format(b.name))
+            return 0
+
+        mergeinfo = parse_mergeinfo_prop(mergeinfo_prop)
+        merged = mergeinfo.get(source, IntervalSet())
+        # Revisions that are not imported yet have to be applied again
+        # on the next run
+        max_revision = Commit.objects.aggregate(Max('svn_revision'))['svn_revision__max'] or 0
+        applied = merged - IntervalSet([(max_revision + 1, sys.maxsize)])
+        new_ranges = applied - IntervalSet.from_string(snapshot.merged)
+
+        with transaction.atomic():
+            added = self.sync_branch(b, new_ranges, chunk_size)
+            if applied == merged:
+                snapshot.last_changed_revision = last_changed_revision
+                snapshot.digest = digest
+            snapshot.merged = str(applied)
+            snapshot.save()
+
+        self.stdout.write('Branch {}: {} new ranges, {} commits marked as merged'.format(b.name, len(new_ranges), added))
+        return added
+
+    def sync_branch(self, b, intervals, chunk_size):
+        """Add merged_to rows for commits with revisions in IntervalSet
+           that are not marked as merged to the branch yet
+        """
+        shas = set()
+        for chunk in batches(intervals, chunk_size):
+            q = Q()
+            for first, last in chunk:
+                if first == last:
+                    q |= Q(svn_revision=first)
+                else:
+                    q |= Q(svn_revision__range=(first, last))
+            shas.update(Commit.objects.filter(q).values_list('sha', flat=True))
+
+        merged, missing = merged_to_delta(b, shas)
+        writer = CommitWriter()
+        for sha in merged:
+            writer.add_relation(Commit.merged_to.through, commit_id=sha, branch_id=b.pk)
+        writer.flush()
+        refresh_status(b, merged)
+        return len(merged)
@@ -21,26 +21,15 @@
 #  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
-from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
-from django.utils.crypto import get_random_string
 
-from mfctracker.models import Commit, UserProfile
+from mfctracker.models import Commit
+from mfctracker.users import provision_users
 
 class Command(BaseCommand):
     help = 'Create users for every known committer'
 
     def handle(self, *args, **options):
         committers = set(Commit.objects.values_list('author', flat=True).distinct())
-        for committer in committers:
-            try:
-                user = User.objects.get(username=committer)
-                if user.profile is None:
-                    profile = UserProfile.objects.create(share_token=get_random_string(length=8), user=user)
-                    profile.save()
-            except User.DoesNotExist:
-                email = '{}@{}'.format(committer, settings.SVN_EMAIL_DOMAIN)
-                password = get_random_string(length=32)
-                self.stdout.write('User does not exist, adding: {}'.format(committer, password))
-                User.objects.create_user(committer, email, password)
+        for committer in provision_users(committers):
+            self.stdout.write('User does not exist, adding: {}'.format(committer))
@@ -0,0 +1,89 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+from datetime import date
+
+from django.db import transaction
+
+from mfctracker.models import Branch, Commit, MfcStatus
+from mfctracker.pagecache import invalidate_imports
+from mfctracker.utils import batches
+
+def commit_state(mfc_after, merged, today):
+    if merged:
+        return MfcStatus.STATE_DONE
+    if mfc_after is None:
+        return MfcStatus.STATE_NO_DATE
+    if mfc_after <= today:
+        return MfcStatus.STATE_READY
+    return MfcStatus.STATE_WAITING
+
+def refresh_status(branch, shas=None, today=None, chunk_size=1000):
+    """Recompute MFC status rows of the maintenance branch for trunk
+       commits in shas, or for all trunk commits after the branch point
+       if shas is None. Returns number of rows written.
+    """
+    if today is None:
+        today = date.today()
+
+    commits = Commit.objects.filter(branch__is_trunk=True, date__gt=branch.branch_date)
+    if shas is None:
+        chunks = batches(commits.order_by('commit_counter').values_list('sha', flat=True).iterator(), chunk_size)
+    else:
+        chunks = batches(sorted(set(shas)), chunk_size)
+
+    through = Commit.merged_to.through
+    written = 0
+    with transaction.atomic():
+        if shas is None:
+            MfcStatus.objects.filter(branch=branch).delete()
+        for chunk in chunks:
+            merged = set(through.objects.filter(branch_id=branch.pk, commit_id__in=chunk).values_list('commit_id', flat=True))
+            rows = []
+            for sha, mfc_after, commit_counter in commits.filter(sha__in=chunk).values_list('sha', 'mfc_after', 'commit_counter'):
+                state = commit_state(mfc_after, sha in merged, today)
+                rows.append(MfcStatus(branch=branch, commit_id=sha, state=state,
+                    mfc_after=mfc_after, commit_counter=commit_counter))
+            MfcStatus.objects.filter(branch=branch, commit_id__in=chunk).delete()
+            MfcStatus.objects.bulk_create(rows, batch_size=chunk_size)
+            written += len(rows)
+        invalidate_imports()
+    return written
+
+def refresh_trunk_commits(shas, today=None):
+    """Add status rows of new trunk commits for every maintenance branch"""
+    written = 0
+    for branch in Branch.maintenance():
+        written += refresh_status(branch, shas, today)
+    return written
+
+def advance_status(today=None):
+    """Daily transition of waiting commits whose MFC date has come.
+       Returns number of updated rows.
+    """
+    if today is None:
+        today = date.today()
+    updated = MfcStatus.objects.filter(state=MfcStatus.STATE_WAITING, mfc_after__lte=today).update(state=MfcStatus.STATE_READY)
+    if updated:
+        invalidate_imports()
+    return updated
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0002_commit_commit_counter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commit',
+            name='svn_revision',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+    ]
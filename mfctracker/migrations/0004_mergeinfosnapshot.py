@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0003_commit_svn_revision_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MergeinfoSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=128)),
+                ('last_changed_revision', models.IntegerField(null=True)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+                ('merged', models.TextField(blank=True)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mergeinfo_snapshots', to='mfctracker.Branch')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mergeinfosnapshot',
+            unique_together=set([('branch', 'source')]),
+        ),
+    ]
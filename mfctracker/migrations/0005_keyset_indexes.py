@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0004_mergeinfosnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='change',
+            name='path',
+            field=models.CharField(db_index=True, max_length=1024),
+        ),
+        migrations.AlterIndexTogether(
+            name='commit',
+            index_together=set([('branch', 'commit_counter')]),
+        ),
+    ]
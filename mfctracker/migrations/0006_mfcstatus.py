@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def commit_state(mfc_after, merged, today):
+    if merged:
+        return 'done'
+    if mfc_after is None:
+        return 'no'
+    if mfc_after <= today:
+        return 'ready'
+    return 'wait'
+
+
+def fill_status(apps, schema_editor):
+    Branch = apps.get_model('mfctracker', 'Branch')
+    Commit = apps.get_model('mfctracker', 'Commit')
+    MfcStatus = apps.get_model('mfctracker', 'MfcStatus')
+    through = Commit.merged_to.through
+    today = date.today()
+    for branch in Branch.objects.filter(is_trunk=False):
+        merged = set(through.objects.filter(branch_id=branch.pk).values_list('commit_id', flat=True))
+        commits = Commit.objects.filter(branch__is_trunk=True, date__gt=branch.branch_date)
+        rows = []
+        for sha, mfc_after, commit_counter in commits.values_list('sha', 'mfc_after', 'commit_counter').iterator():
+            rows.append(MfcStatus(branch_id=branch.pk, commit_id=sha, state=commit_state(mfc_after, sha in merged, today),
+                mfc_after=mfc_after, commit_counter=commit_counter))
+            if len(rows) >= 1000:
+                MfcStatus.objects.bulk_create(rows)
+                rows = []
+        MfcStatus.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0005_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MfcStatus',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(max_length=8)),
+                ('mfc_after', models.DateField(blank=True, null=True)),
+                ('commit_counter', models.IntegerField(null=True)),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mfc_status', to='mfctracker.Branch')),
+                ('commit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mfc_status', to='mfctracker.Commit')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='mfcstatus',
+            unique_together=set([('branch', 'commit')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='mfcstatus',
+            index_together=set([('branch', 'state', 'commit_counter'), ('state', 'mfc_after')]),
+        ),
+        migrations.RunPython(fill_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0006_mfcstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Path',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+            ],
+        ),
+        migrations.RenameField(
+            model_name='change',
+            old_name='path',
+            new_name='path_text',
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='path',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='changes', to='mfctracker.Path'),
+        ),
+        migrations.RunSQL(
+            sql=[
+                'INSERT INTO mfctracker_path (path) SELECT DISTINCT path_text FROM mfctracker_change',
+                'UPDATE mfctracker_change SET path_id = mfctracker_path.id FROM mfctracker_path WHERE mfctracker_path.path = mfctracker_change.path_text',
+                # Check deferred path_id constraint now, ALTER TABLE
+                # below fails with pending trigger events otherwise
+                'SET CONSTRAINTS ALL IMMEDIATE',
+            ],
+            reverse_sql=[
+                'UPDATE mfctracker_change SET path_text = mfctracker_path.path FROM mfctracker_path WHERE mfctracker_path.id = mfctracker_change.path_id',
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='change',
+            name='path_text',
+        ),
+        migrations.AlterField(
+            model_name='change',
+            name='path',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='changes', to='mfctracker.Path'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0007_path_dictionary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commit',
+            name='msg_search',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE mfctracker_commit SET msg_search = to_tsvector('english', msg)",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='commit',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['msg_search'], name='mfctracker_msg_search_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def connected_components(pairs):
+    """Split X-MFC-With edges into lists of connected SHAs"""
+    parent = {}
+
+    def find(key):
+        root = parent.setdefault(key, key)
+        while root != parent[root]:
+            root = parent[root]
+        while key != root:
+            parent[key], key = root, parent[key]
+        return root
+
+    for a, b in pairs:
+        root_a = find(a)
+        root_b = find(b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+
+    components = {}
+    for key in list(parent.keys()):
+        components.setdefault(find(key), []).append(key)
+    return list(components.values())
+
+
+def build_dependency_groups(apps, schema_editor):
+    Commit = apps.get_model('mfctracker', 'Commit')
+    through = Commit.mfc_with.through
+    pairs = through.objects.values_list('from_commit_id', 'to_commit_id')
+    for group, shas in enumerate(connected_components(pairs), 1):
+        Commit.objects.filter(sha__in=shas).update(dependency_group=group)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0008_commit_msg_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commit',
+            name='dependency_group',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.RunPython(build_dependency_groups, migrations.RunPython.noop),
+    ]
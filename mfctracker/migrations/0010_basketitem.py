@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_baskets(apps, schema_editor):
+    UserProfile = apps.get_model('mfctracker', 'UserProfile')
+    BasketItem = apps.get_model('mfctracker', 'BasketItem')
+    items = []
+    for profile in UserProfile.objects.all():
+        seen = set()
+        for sha in profile.mfc_basket or []:
+            if sha not in seen:
+                seen.add(sha)
+                items.append(BasketItem(profile=profile, sha=sha))
+    BasketItem.objects.bulk_create(items, batch_size=1000)
+
+
+def restore_baskets(apps, schema_editor):
+    UserProfile = apps.get_model('mfctracker', 'UserProfile')
+    BasketItem = apps.get_model('mfctracker', 'BasketItem')
+    for profile in UserProfile.objects.all():
+        profile.mfc_basket = list(BasketItem.objects.filter(profile=profile).order_by('pk').values_list('sha', flat=True))
+        profile.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mfctracker', '0009_commit_dependency_group'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BasketItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha', models.CharField(max_length=64)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='basket_items', to='mfctracker.UserProfile')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='basketitem',
+            unique_together=set([('profile', 'sha')]),
+        ),
+        migrations.RunPython(copy_baskets, restore_baskets),
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='mfc_basket',
+        ),
+    ]
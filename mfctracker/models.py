@@ -21,14 +21,21 @@
 #  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
+from collections import OrderedDict
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.utils.crypto import get_random_string
 
-import jsonfield
+from .pagecache import invalidate_branches, invalidate_user
+
+# Text search configuration of commit message search vectors
+SEARCH_CONFIG = 'english'
 
 class Branch(models.Model):
     """Branch info"""
@@ -57,7 +64,7 @@ class Branch(models.Model):
 class Commit(models.Model):
     """Single commit info"""
     sha = models.CharField(primary_key=True, max_length=64)
-    svn_revision = models.IntegerField(null=True)
+    svn_revision = models.IntegerField(null=True, db_index=True)
     commit_counter = models.IntegerField(null=True)
     author = models.CharField(max_length=30)
     date = models.DateTimeField()
@@ -66,6 +73,16 @@ class Commit(models.Model):
     merged_to = models.ManyToManyField(Branch, blank=True, related_name='merges')
     branch = models.ForeignKey(Branch, null=True, on_delete=models.SET_NULL, related_name='commits')
     mfc_with = models.ManyToManyField("self", blank=True)
+    # Connected component of mfc_with graph, None for commits without
+    # X-MFC-With relations. Maintained by the importer
+    dependency_group = models.IntegerField(null=True, db_index=True)
+    # to_tsvector(SEARCH_CONFIG, msg), filled in by the importer
+    msg_search = SearchVectorField(null=True)
+
+    class Meta:
+        # Keyset pagination walks branch commits by counter
+        index_together = (('branch', 'commit_counter'),)
+        indexes = [GinIndex(fields=['msg_search'], name='mfctracker_msg_search_idx')]
 
     @classmethod
     def create(cls, sha, author, date, msg):
@@ -100,8 +117,70 @@ class Commit(models.Model):
     def sha_abbr(self):
         return self.sha[:8]
 
+class MergeinfoSnapshot(models.Model):
+    """svn:mergeinfo of the branch last processed by syncsvn"""
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='mergeinfo_snapshots')
+    # Merge source path, e.g. /head
+    source = models.CharField(max_length=128)
+    # Last changed revision of the branch root
+    last_changed_revision = models.IntegerField(null=True)
+    # SHA-256 of the whole svn:mergeinfo property
+    digest = models.CharField(max_length=64, blank=True)
+    # Revisions merged from source in svn:mergeinfo format
+    merged = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('branch', 'source')
+
+class MfcStatus(models.Model):
+    """MFC state of trunk commit for maintenance branch, denormalized
+       from Commit.mfc_after and merged_to so branch page filters are
+       index range scans. Maintained by mfctracker.mfcstatus
+    """
+    STATE_DONE = 'done'
+    STATE_READY = 'ready'
+    STATE_WAITING = 'wait'
+    STATE_NO_DATE = 'no'
+
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='mfc_status')
+    commit = models.ForeignKey(Commit, on_delete=models.CASCADE, related_name='mfc_status')
+    state = models.CharField(max_length=8)
+    mfc_after = models.DateField(blank=True, null=True)
+    # Copy of Commit.commit_counter for keyset pagination
+    commit_counter = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('branch', 'commit')
+        index_together = (
+            ('branch', 'state', 'commit_counter'),
+            ('state', 'mfc_after'),
+        )
+
+class Path(models.Model):
+    """Dictionary of changed paths. Unique index doubles as prefix
+       index, so "everything under sys/dev/" is a range scan here and
+       integer lookups in Change
+    """
+    path = models.CharField(max_length=1024, unique=True)
+
+    @classmethod
+    def ids(cls, paths, chunk_size=1000):
+        """Map path strings to ids, missing paths are added to the
+           dictionary
+        """
+        paths = sorted(set(paths))
+        ids = {}
+        for i in range(0, len(paths), chunk_size):
+            chunk = paths[i:i + chunk_size]
+            ids.update(cls.objects.filter(path__in=chunk).values_list('path', 'id'))
+            missing = [cls(path=path) for path in chunk if path not in ids]
+            if missing:
+                cls.objects.bulk_create(missing)
+                ids.update(cls.objects.filter(path__in=[obj.path for obj in missing]).values_list('path', 'id'))
+        return ids
+
 class Change(models.Model):
-    path = models.CharField(max_length=1024)
+    path = models.ForeignKey(Path, on_delete=models.PROTECT, related_name='changes')
     commit = models.ForeignKey(Commit, on_delete=models.CASCADE, related_name='changes')
 
     @classmethod
@@ -114,7 +193,6 @@ class UserProfile(models.Model):
     '''User-specific data like basket, share URL, etc...'''
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     share_token = models.CharField(max_length=30, blank=True)
-    mfc_basket = jsonfield.JSONField(default=[])
     do_not_merge = models.ManyToManyField(Commit, blank=True)
 
     @classmethod
@@ -124,6 +202,46 @@ class UserProfile(models.Model):
         obj.share_token = get_random_string(length=8)
         return obj
 
+    @property
+    def mfc_basket(self):
+        """SHAs in MFC basket in the order they were added"""
+        return list(self.basket_items.order_by('pk').values_list('sha', flat=True))
+
+    def add_to_basket(self, shas):
+        """Append SHAs that are not in the basket yet, keeping order.
+           Safe to call concurrently, only new rows are inserted.
+        """
+        shas = list(OrderedDict.fromkeys(shas))
+        if not shas:
+            return
+        existing = set(self.basket_items.filter(sha__in=shas).values_list('sha', flat=True))
+        items = [BasketItem(profile=self, sha=sha) for sha in shas if sha not in existing]
+        try:
+            with transaction.atomic():
+                BasketItem.objects.bulk_create(items)
+        except IntegrityError:
+            # Concurrent request added some of them
+            for item in items:
+                BasketItem.objects.get_or_create(profile=self, sha=item.sha)
+        invalidate_user(self.user_id)
+
+    def remove_from_basket(self, sha):
+        self.basket_items.filter(sha=sha).delete()
+        invalidate_user(self.user_id)
+
+    def clear_basket(self):
+        self.basket_items.all().delete()
+        invalidate_user(self.user_id)
+
+
+class BasketItem(models.Model):
+    '''Commit in user's MFC basket, primary key keeps the order'''
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='basket_items')
+    sha = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('profile', 'sha')
+
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -141,3 +259,39 @@ class CommitNote(models.Model):
     def create(cls, commit, user, text):
         note = cls(commit=commit, user=user, text=text)
         return note
+
+
+@receiver(post_save, sender=CommitNote)
+@receiver(post_delete, sender=CommitNote)
+def invalidate_note_pages(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_profile_pages(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(m2m_changed, sender=UserProfile.do_not_merge.through)
+def invalidate_do_not_merge_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_user(instance.user_id)
+    elif pk_set:
+        for user_id in UserProfile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True):
+            invalidate_user(user_id)
+
+
+def branch_fields_changed(update_fields):
+    """Importer saves only last_commit of branches, which is not part of
+       cached branch lists
+    """
+    return update_fields is None or not set(update_fields) <= {'last_commit'}
+
+
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def invalidate_branch_lists(sender, instance, **kwargs):
+    if branch_fields_changed(kwargs.get('update_fields', None)):
+        invalidate_branches()
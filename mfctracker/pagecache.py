@@ -0,0 +1,94 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+PAGE_CACHE_TIMEOUT = 3600
+
+IMPORT_GENERATION_KEY = 'mfctracker:generation:import'
+USER_GENERATION_KEY = 'mfctracker:generation:user:{}'
+BRANCHES_GENERATION_KEY = 'mfctracker:generation:branches'
+
+def _generation(key):
+    value = cache.get(key)
+    if value is None:
+        # Start from current time, not 1: if the counter is evicted
+        # entries cached under its old values must not become valid again
+        cache.add(key, int(time.time() * 1000), None)
+        value = cache.get(key)
+    return value
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        _generation(key)
+
+def _invalidate(key):
+    # Bump right away and once more after the transaction commits, so
+    # pages cached by readers that still saw old data are dropped too
+    _bump(key)
+    transaction.on_commit(lambda: _bump(key))
+
+def import_generation():
+    """Generation of imported data: commits, merges, MFC status"""
+    return _generation(IMPORT_GENERATION_KEY)
+
+def invalidate_imports():
+    _invalidate(IMPORT_GENERATION_KEY)
+
+def user_generation(user_id):
+    """Generation of user's notes, "never MFC" list, basket and token"""
+    return _generation(USER_GENERATION_KEY.format(user_id))
+
+def invalidate_user(user_id):
+    _invalidate(USER_GENERATION_KEY.format(user_id))
+
+def branches_generation():
+    """Generation of Branch table, see mfctracker.registry"""
+    return _generation(BRANCHES_GENERATION_KEY)
+
+def invalidate_branches():
+    _invalidate(BRANCHES_GENERATION_KEY)
+
+def cached(name, parts, compute, users=()):
+    """Return result of compute() cached by name, parts, generation of
+       imported data and generations of users. Entries are never
+       invalidated explicitly, bumped generations just change the key.
+    """
+    key_parts = [name, import_generation()]
+    for user in users:
+        if user.is_authenticated():
+            key_parts.append((user.pk, user_generation(user.pk)))
+    key_parts.extend(parts)
+    key = 'mfctracker:page:' + hashlib.sha1(repr(key_parts).encode('utf-8')).hexdigest()
+
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, PAGE_CACHE_TIMEOUT)
+    return value
@@ -0,0 +1,104 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+import hashlib
+
+from django.core.cache import cache
+
+COUNT_CACHE_TIMEOUT = 300
+
+class KeysetPage(object):
+    """Page of queryset rows ordered by descending unique key.
+
+       Instead of OFFSET the page is located by the key of the last row
+       on the previous page (after) or the first row on the next page
+       (before), so every page costs the same index range scan.
+    """
+
+    def __init__(self, object_list, key, has_next, has_previous, count=None):
+        self.object_list = object_list
+        self.key = key
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    @property
+    def next_cursor(self):
+        if not self.has_next_page or not self.object_list:
+            return None
+        return getattr(self.object_list[-1], self.key)
+
+    @property
+    def previous_cursor(self):
+        if not self.has_previous_page or not self.object_list:
+            return None
+        return getattr(self.object_list[0], self.key)
+
+def keyset_page(queryset, key, per_page, after=None, before=None):
+    """Return KeysetPage of queryset ordered by -key. after/before are
+       keys of the row adjacent to the requested page; if both are None
+       or the cursor points past the end first page is returned.
+    """
+    if after is not None:
+        rows = list(queryset.filter(**{key + '__lt': after}).order_by('-' + key)[:per_page + 1])
+        if rows:
+            return KeysetPage(rows[:per_page], key, len(rows) > per_page, True)
+    elif before is not None:
+        rows = list(queryset.filter(**{key + '__gt': before}).order_by(key)[:per_page + 1])
+        if rows:
+            has_previous = len(rows) > per_page
+            rows = rows[:per_page]
+            rows.reverse()
+            return KeysetPage(rows, key, True, has_previous)
+
+    rows = list(queryset.order_by('-' + key)[:per_page + 1])
+    return KeysetPage(rows[:per_page], key, len(rows) > per_page, False)
+
+def cached_count(queryset, version=''):
+    """COUNT(*) of queryset cached by its SQL and version, callers pass
+       something that changes with the underlying data, e.g. import
+       watermark. Total may be stale for COUNT_CACHE_TIMEOUT seconds.
+    """
+    sql, params = queryset.query.sql_with_params()
+    digest = hashlib.sha1('{}\0{!r}\0{}'.format(sql, params, version).encode('utf-8')).hexdigest()
+    cache_key = 'mfctracker:count:' + digest
+    count = cache.get(cache_key)
+    if count is None:
+        count = queryset.count()
+        cache.set(cache_key, count, COUNT_CACHE_TIMEOUT)
+    return count
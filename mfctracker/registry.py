@@ -0,0 +1,111 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+
+from .models import Branch, branch_fields_changed
+from .pagecache import branches_generation
+
+# How often, in seconds, processes check if branches were changed by
+# another process. Changes in this process are picked up right away
+GENERATION_CHECK_INTERVAL = 10
+
+class BranchRegistry(object):
+    """In-process snapshot of the Branch table. Loaded with one query
+       and reloaded when branches are saved or deleted, here or in any
+       other process. Returned objects are shared between requests and
+       must not be modified. last_commit is not kept up to date.
+    """
+
+    def __init__(self, check_interval=GENERATION_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._generation = None
+        self._checked = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def _get_snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._snapshot is not None and now - self._checked >= self.check_interval:
+                self._checked = now
+                if branches_generation() != self._generation:
+                    self._snapshot = None
+
+            if self._snapshot is None:
+                self._generation = branches_generation()
+                self._checked = now
+                branches = list(Branch.objects.all())
+                by_pk = {b.pk: b for b in branches}
+                trunk = None
+                for b in branches:
+                    if b.is_trunk:
+                        trunk = b
+                maintenance = [b for b in branches if not b.is_trunk]
+                maintenance.sort(key=lambda b: b.name, reverse=True)
+                maintenance.sort(key=lambda b: b.branch_date, reverse=True)
+                self._snapshot = (by_pk, trunk, maintenance)
+
+            return self._snapshot
+
+    def get(self, pk):
+        """Branch by primary key or None"""
+        by_pk, trunk, maintenance = self._get_snapshot()
+        try:
+            return by_pk.get(int(pk), None)
+        except (TypeError, ValueError):
+            return None
+
+    def trunk(self):
+        by_pk, trunk, maintenance = self._get_snapshot()
+        if trunk is None:
+            raise Branch.DoesNotExist('Trunk branch does not exist')
+        return trunk
+
+    def maintenance(self):
+        """Maintenance branches, newest first"""
+        by_pk, trunk, maintenance = self._get_snapshot()
+        return list(maintenance)
+
+branch_registry = BranchRegistry()
+
+def get_branch_or_404(pk):
+    branch = branch_registry.get(pk)
+    if branch is None:
+        raise Http404('No branch matches the given query.')
+    return branch
+
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def invalidate_branch_registry(sender, instance, **kwargs):
+    if branch_fields_changed(kwargs.get('update_fields', None)):
+        branch_registry.invalidate()
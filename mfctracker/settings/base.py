@@ -66,6 +66,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.auth',
+    'django.contrib.postgres',
     'bootstrap3',
     'mfctracker',
 ]
@@ -142,6 +143,13 @@ DATABASES = {
     'default': env.db(default='pgsql://mfctracker@localhost/mfctracker'),
 }
 
+# Page cache and its generation counters have to be shared by web
+# workers and importer, local memory is only good for a single process
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://mfctracker'),
+}
+CACHES['default'].setdefault('OPTIONS', {}).setdefault('MAX_ENTRIES', 5000)
+
 AUTH_LDAP_ENABLED = env.bool('AUTH_LDAP_ENABLED', default=False)
 if AUTH_LDAP_ENABLED:
     import ldap
@@ -26,3 +26,8 @@ from .base import *
 DEBUG = False
 
 ALLOWED_HOSTS = ['*']
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='dbcache://mfctracker_cache'),
+}
+CACHES['default'].setdefault('OPTIONS', {}).setdefault('MAX_ENTRIES', 20000)
@@ -34,6 +34,9 @@ def commit_note(commit, user):
     if user.is_anonymous():
         return None
 
+    if hasattr(commit, 'user_note'):
+        return commit.user_note
+
     try:
         note = commit.notes.get(user=user)
         return note
@@ -34,6 +34,9 @@ def do_not_merge(commit, user):
     if user.is_anonymous():
         return False
 
+    if hasattr(commit, 'user_banned'):
+        return commit.user_banned
+
     try:
         return user.profile.do_not_merge.filter(sha=commit.sha).exists()
     except ObjectDoesNotExist:
@@ -30,7 +30,12 @@ register = template.Library()
 
 @register.filter
 def mfc_state(commit, branch):
-    if commit.merged_to.filter(pk=branch.pk).exists():
+    # merged_to_branch is set by views.annotate_commits for the branch
+    # being rendered, fall back to query for non-annotated commits
+    merged = getattr(commit, 'merged_to_branch', None)
+    if merged is None:
+        merged = commit.merged_to.filter(pk=branch.pk).exists()
+    if merged:
         return "done"
 
     if commit.mfc_after is None:
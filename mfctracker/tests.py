@@ -21,15 +21,46 @@
 #  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+import threading
 import pytest
+import svn.common
+
+from git import Repo
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+
+from .dependencies import connected_components, merge_dependency_groups, missing_dependencies
+from .gitutils import NotesReader, is_ancestor, iter_log
+from .importer import CommitWriter, branch_lock, merged_to_delta, resolve_mfc_with
+from .registry import BranchRegistry, branch_registry
+from .users import provision_users
+from .utils import batches, get_mfc_requirements, parse_mergeinfo_prop, mergeinfo_ranges_to_set, get_svn_revision, \
+    parse_commit_metadata, parse_mfc_after, IntervalSet
+from .management.commands.importcommits import Command as ImportCommand
+from .management.commands.syncd import Command as SyncdCommand
+from .management.commands.syncsvn import Command as SyncSvnCommand
+from .mfcstatus import advance_status, refresh_status, refresh_trunk_commits
+from .models import Branch, Commit, CommitNote, Change, MfcStatus, Path
+from .pagecache import cached, invalidate_imports, user_generation
+from .pagination import keyset_page
+from .views import annotate_commits, annotate_search, mfc_commit_message, parse_extended_filters, parse_filters, search_query
 
-from .utils import get_mfc_requirements, parse_mergeinfo_prop, mergeinfo_ranges_to_set
-from .models import Commit, CommitNote
+@pytest.fixture(autouse=True)
+def reset_branch_registry():
+    # Rolled back test transactions do not send signals
+    branch_registry.invalidate()
 
 @pytest.fixture()
 def valid_user(request):
@@ -74,6 +105,156 @@ class TestUtils(TestCase):
         revisions = mergeinfo_ranges_to_set(mergeinfo['/repo'])
         self.assertEqual(revisions, set(range(1,6)))
 
+    def test_commit_metadata(self):
+        msg = 'Fix iwm\n\nMFC after:\t2 weeks\nX-MFC-With: r100, abcdef\n(cherry picked from commit 0123abcd)\n'
+        commit_date = datetime(2021, 1, 31, 23, 30, tzinfo=timezone.utc)
+        metadata = parse_commit_metadata(msg, commit_date, 'svn path=/head/; revision=368070')
+        self.assertEqual(metadata.mfc_after, date(2021, 2, 14))
+        self.assertEqual(metadata.mfc_with, {'100', 'abcdef'})
+        self.assertEqual(metadata.cherry_picked, {'0123abcd'})
+        self.assertEqual(metadata.svn_revision, 368070)
+        self.assertEqual(metadata.errors, [])
+
+    def test_commit_metadata_bad_mfc_after(self):
+        commit_date = datetime(2021, 1, 31, 23, 30, tzinfo=timezone.utc)
+        metadata = parse_commit_metadata('MFC after: never\nMFC after: 3 days', commit_date)
+        self.assertEqual(metadata.mfc_after, date(2021, 2, 3))
+        self.assertEqual(len(metadata.errors), 1)
+
+    def test_commit_metadata_single_line(self):
+        commit_date = datetime(2021, 1, 31, 23, 30, tzinfo=timezone.utc)
+        metadata = parse_commit_metadata('foo\n\n\nMFC after: never', commit_date)
+        self.assertEqual(metadata.errors, [u'Failed to parse MFC line: \'MFC after: never\''])
+        metadata = parse_commit_metadata('MFC\nafter: 3 days\nX-MFC\nwith: r100', commit_date)
+        self.assertIsNone(metadata.mfc_after)
+        self.assertEqual(metadata.mfc_with, set())
+        self.assertEqual(metadata.errors, [])
+
+    def test_mfc_after(self):
+        commit_date = datetime(2021, 1, 31, 23, 30, tzinfo=timezone.utc)
+        self.assertEqual(parse_mfc_after('MFC after: 1 month', commit_date), date(2021, 2, 28))
+        self.assertEqual(parse_mfc_after('MFC after: 2020-01-05', commit_date), date(2020, 1, 5))
+        self.assertEqual(parse_mfc_after('MFC after: 3 days', commit_date), date(2021, 2, 3))
+        commit_date = datetime(2021, 3, 14, 1, 0, tzinfo=timezone.utc)
+        self.assertEqual(parse_mfc_after('MFC after: 3 days', commit_date), date(2021, 3, 17))
+
+    def test_mfc_after_leap_year(self):
+        commit_date = datetime(2020, 2, 28, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(parse_mfc_after('MFC after: 1 year', commit_date), date(2021, 2, 28))
+        self.assertEqual(parse_mfc_after('MFC after: 2 years', commit_date), date(2022, 2, 28))
+        commit_date = datetime(2021, 2, 28, 12, 0, tzinfo=timezone.utc)
+        self.assertEqual(parse_mfc_after('MFC after: 1 year', commit_date), date(2022, 2, 28))
+
+    def test_batches(self):
+        self.assertEqual(list(batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(batches([], 2)), [])
+
+    def test_mergeinfo_intervals(self):
+        mergeinfo = parse_mergeinfo_prop('/head:1-3,4*,5,10-20*,15-25,27\n/stable/11:3')
+        self.assertEqual(list(mergeinfo['/head']), [(1, 5), (10, 25), (27, 27)])
+        self.assertEqual(list(mergeinfo['/stable/11']), [(3, 3)])
+
+    def test_interval_set(self):
+        intervals = IntervalSet([(10, 20), (1, 3), (4, 5), (30, 30)])
+        self.assertEqual(list(intervals), [(1, 5), (10, 20), (30, 30)])
+        self.assertEqual(intervals.count(), 17)
+        self.assertIn(15, intervals)
+        self.assertNotIn(25, intervals)
+        self.assertNotIn(0, intervals)
+        intervals.add(6, 9)
+        intervals.add(25)
+        self.assertEqual(list(intervals), [(1, 20), (25, 25), (30, 30)])
+
+    def test_interval_set_string(self):
+        intervals = IntervalSet.from_string('1-3,4*,10-20*,27')
+        self.assertEqual(str(intervals), '1-4,10-20,27')
+        self.assertEqual(IntervalSet.from_string(str(intervals)), intervals)
+        self.assertEqual(str(IntervalSet.from_string('')), '')
+
+    def test_interval_set_operations(self):
+        a = IntervalSet([(1, 10), (20, 30)])
+        b = IntervalSet([(5, 22)])
+        self.assertEqual(list(a | b), [(1, 30)])
+        self.assertEqual(list(a - b), [(1, 4), (23, 30)])
+        self.assertEqual(list(b - a), [(11, 19)])
+        self.assertEqual(list(a.gaps()), [(11, 19)])
+        self.assertEqual(list(a.gaps(0, 35)), [(0, 0), (11, 19), (31, 35)])
+
+    def test_svn_revision(self):
+        self.assertEqual(get_svn_revision('svn path=/head/; revision=368070'), 368070)
+        self.assertIsNone(get_svn_revision('no revision here'))
+
+class GitRepoTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.repo = Repo.init(self.path)
+        self.repo.git.config('user.email', 'gonzo@freebsd.org')
+        self.repo.git.config('user.name', 'gonzo')
+        self.shas = []
+        for i in range(3):
+            self.repo.git.commit('--allow-empty', '-m', 'commit {}'.format(i))
+            self.shas.append(self.repo.head.commit.hexsha)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+class TestNotesReader(GitRepoTestCase):
+
+    def test_revisions(self):
+        self.repo.git.notes('add', '-m', 'svn path=/head/; revision=100', self.shas[0])
+        self.repo.git.notes('add', '-m', 'svn path=/head/; revision=102', self.shas[2])
+        revisions = NotesReader(self.repo).revisions(self.shas)
+        self.assertEqual(revisions, {self.shas[0]: 100, self.shas[2]: 102})
+
+    def test_batches(self):
+        self.repo.git.notes('add', '-m', 'svn path=/head/; revision=100', self.shas[0])
+        self.repo.git.notes('add', '-m', 'svn path=/head/; revision=102', self.shas[2])
+        reader = NotesReader(self.repo)
+        self.assertEqual(reader.revisions(self.shas[:2]), {self.shas[0]: 100})
+        self.assertEqual(reader.revisions(self.shas[2:]), {self.shas[2]: 102})
+
+    def test_listed(self):
+        self.repo.git.notes('add', '-m', 'svn path=/head/; revision=100', self.shas[0])
+        reader = NotesReader(self.repo, lookup_limit=0)
+        self.assertEqual(reader.revisions(self.shas), {self.shas[0]: 100})
+
+    def test_no_notes(self):
+        revisions = NotesReader(self.repo).revisions(self.shas)
+        self.assertEqual(revisions, {})
+
+class TestLogWalker(GitRepoTestCase):
+
+    def commit_files(self, *paths):
+        for path in paths:
+            full_path = os.path.join(self.path, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as f:
+                f.write(path)
+        self.repo.index.add(list(paths))
+        self.repo.index.commit('add files\n\nMFC after: 2 weeks')
+        return self.repo.head.commit.hexsha
+
+    def test_range(self):
+        entries = list(iter_log(self.repo, '{}..HEAD'.format(self.shas[0])))
+        self.assertEqual([entry.sha for entry in entries], self.shas[1:])
+        self.assertEqual(entries[0].message, 'commit 1\n')
+        self.assertEqual(entries[0].committer_email, 'gonzo@freebsd.org')
+        self.assertEqual(entries[0].paths, [])
+
+    def test_paths(self):
+        first = self.commit_files('sys/dev/a.c', 'sys/dev/b c.c')
+        second = self.commit_files('bin/ls/ls.c')
+        entries = list(iter_log(self.repo, '{}..HEAD'.format(self.shas[-1]), with_paths=True, chunk_size=7))
+        self.assertEqual([(entry.sha, entry.paths) for entry in entries],
+            [(first, ['sys/dev/a.c', 'sys/dev/b c.c']), (second, ['bin/ls/ls.c'])])
+        self.assertEqual(entries[1].message, 'add files\n\nMFC after: 2 weeks')
+
+    def test_is_ancestor(self):
+        self.assertTrue(is_ancestor(self.repo, self.shas[0], 'HEAD'))
+        self.assertFalse(is_ancestor(self.repo, 'HEAD', self.shas[0]))
+        self.assertFalse(is_ancestor(self.repo, '0' * 40, 'HEAD'))
+
 @pytest.mark.django_db()
 class TestComments():
 
@@ -140,3 +321,816 @@ class TestComments():
         response = loggedin_client.post(reverse('del_do_not_merge', kwargs={'revision': commit.revision}))
         assert response.status_code == 204
         assert valid_user.profile.do_not_merge.count() == 0
+
+class TestSyncdRefs(GitRepoTestCase):
+
+    def test_remote_refs(self):
+        self.repo.git.update_ref('refs/remotes/origin/main', self.shas[2])
+        self.repo.git.update_ref('refs/remotes/origin/stable/13', self.shas[1])
+        refs = SyncdCommand().remote_refs(self.repo)
+        self.assertEqual(refs, {'main': self.shas[2], 'stable/13': self.shas[1]})
+
+    def test_write_status(self):
+        path = os.path.join(self.path, 'status.json')
+        SyncdCommand().write_status(path, {'error': None, 'branches': {}})
+        with open(path) as f:
+            self.assertEqual(json.load(f), {'error': None, 'branches': {}})
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+@pytest.mark.django_db()
+class TestCommitWriter():
+
+    def test_flush(self, valid_user):
+        writer = CommitWriter(batch_size=2)
+        for i in range(3):
+            commit = Commit.create('{:040x}'.format(i), valid_user.username, datetime.now(), 'commit message')
+            writer.add_commit(commit, ['head/file{}'.format(i)])
+        writer.add_relation(Commit.mfc_with.through, from_commit_id='{:040x}'.format(0), to_commit_id='{:040x}'.format(1))
+        writer.add_relation(Commit.mfc_with.through, from_commit_id='{:040x}'.format(0), to_commit_id='{:040x}'.format(1))
+        assert writer.flush() == 7
+        assert writer.pending() == 0
+        assert Commit.objects.count() == 3
+        assert Change.objects.count() == 3
+        assert Commit.mfc_with.through.objects.count() == 1
+
+    def test_checkpoint(self, valid_user):
+        branch = Branch.create('HEAD', 'main')
+        branch.branch_date = datetime.now()
+        branch.last_commit = 'aaa'
+        branch.save()
+        writer = CommitWriter()
+        writer.add_commit(Commit.create('bbb', valid_user.username, datetime.now(), 'commit message'))
+        branch.last_commit = 'bbb'
+        writer.flush(checkpoint=branch)
+        assert Branch.objects.get(pk=branch.pk).last_commit == 'bbb'
+
+@contextmanager
+def lock_held_elsewhere(branch, shared=False):
+    """Hold branch import lock from another thread, i.e. through another
+       database connection, while the block runs
+    """
+    acquired = threading.Event()
+    release = threading.Event()
+    def hold():
+        try:
+            with branch_lock(branch, shared=shared):
+                acquired.set()
+                release.wait()
+        finally:
+            acquired.set()
+            connection.close()
+    thread = threading.Thread(target=hold)
+    thread.start()
+    acquired.wait()
+    try:
+        yield
+    finally:
+        release.set()
+        thread.join()
+
+@pytest.mark.django_db()
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='advisory locks need PostgreSQL')
+class TestBranchLock():
+
+    @pytest.fixture()
+    def branches(self):
+        trunk = Branch.create('HEAD', 'main')
+        trunk.is_trunk = True
+        trunk.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        trunk.save()
+        stable = Branch.create('STABLE-13', 'stable/13')
+        stable.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        stable.save()
+        return trunk, stable
+
+    def test_exclusive(self, branches):
+        trunk, stable = branches
+        with lock_held_elsewhere(stable):
+            with branch_lock(stable, wait=False) as acquired:
+                assert not acquired
+            with branch_lock(trunk, wait=False) as acquired:
+                assert acquired
+        with branch_lock(stable, wait=False) as acquired:
+            assert acquired
+
+    def test_shared_blocks_exclusive(self, branches):
+        trunk, stable = branches
+        with lock_held_elsewhere(trunk, shared=True):
+            with branch_lock(trunk, wait=False) as acquired:
+                assert not acquired
+            with branch_lock(trunk, shared=True, wait=False) as acquired:
+                assert acquired
+
+    def test_import_locked_branch(self, branches):
+        trunk, stable = branches
+        last_commit = stable.last_commit
+        command = ImportCommand(stdout=StringIO())
+        with lock_held_elsewhere(stable):
+            assert command.import_branch_locked(stable, trunk, {}) is None
+        assert Branch.objects.get(pk=stable.pk).last_commit == last_commit
+        assert not Commit.objects.exists()
+        assert 'being imported by another process' in command.stdout.getvalue()
+
+@pytest.mark.django_db()
+class TestResolveMfcWith():
+
+    def test_resolve(self, valid_user):
+        for sha, revision in (('abc123', 1), ('abc456', 2), ('def789', 3)):
+            commit = Commit.create(sha, valid_user.username, datetime.now(), 'commit message')
+            commit.svn_revision = revision
+            commit.save()
+        pairs, errors = resolve_mfc_with({'def789': {'1', 'abc4', 'abc', 'fff', '99'}})
+        assert sorted(pairs) == [('def789', 'abc123'), ('def789', 'abc456')]
+        assert len(errors) == 3
+
+    def test_resolve_pending(self, valid_user):
+        commit = Commit.create('fff000', valid_user.username, datetime.now(), 'commit message')
+        commit.svn_revision = 99
+        pairs, errors = resolve_mfc_with({'def789': {'99', 'fff'}}, pending=[commit])
+        assert pairs == [('def789', 'fff000'), ('def789', 'fff000')]
+        assert errors == []
+
+@pytest.mark.django_db()
+class TestMergedToDelta():
+
+    def test_delta(self, valid_user):
+        branch = Branch.create('STABLE-12', 'stable/12')
+        branch.branch_date = datetime.now()
+        branch.save()
+        for sha in ('aaa', 'bbb'):
+            commit = Commit.create(sha, valid_user.username, datetime.now(), 'commit message')
+            commit.save()
+        Commit.objects.get(sha='aaa').merged_to.add(branch)
+        merged, missing = merged_to_delta(branch, ['aaa', 'bbb', 'ccc'])
+        assert merged == {'bbb'}
+        assert missing == {'ccc'}
+
+@pytest.mark.django_db()
+class TestProvisionUsers():
+
+    def test_provision(self, valid_user):
+        created = provision_users(['gonzo', 'imp', 'kevans', ''])
+        assert created == ['imp', 'kevans']
+        assert User.objects.count() == 3
+        user = User.objects.get(username='imp')
+        assert not user.has_usable_password()
+        assert user.email == 'imp@freebsd.org'
+        assert len(user.profile.share_token) == 8
+        assert provision_users(['imp']) == []
+
+    def test_concurrent_provision(self, monkeypatch):
+        bulk_create = User.objects.bulk_create
+        def racing_bulk_create(users):
+            # Other process creates one of the users first
+            User.objects.create_user(username='imp', email='imp@freebsd.org')
+            return bulk_create(users)
+        monkeypatch.setattr(User.objects, 'bulk_create', racing_bulk_create)
+        created = provision_users(['imp', 'kevans'])
+        assert created == ['kevans']
+        assert User.objects.count() == 2
+        assert len(User.objects.get(username='kevans').profile.share_token) == 8
+
+@pytest.mark.django_db()
+class TestSyncSvn():
+
+    def test_sync_branch(self, valid_user):
+        branch = Branch.create('STABLE-12', 'stable/12')
+        branch.branch_date = datetime.now()
+        branch.save()
+        for revision in range(1, 8):
+            commit = Commit.create('{:040x}'.format(revision), valid_user.username, datetime.now(), 'commit message')
+            commit.svn_revision = revision
+            commit.save()
+        Commit.objects.get(svn_revision=2).merged_to.add(branch)
+        added = SyncSvnCommand().sync_branch(branch, IntervalSet([(1, 3), (5, 5)]), chunk_size=1)
+        assert added == 3
+        assert sorted(branch.merges.values_list('svn_revision', flat=True)) == [1, 2, 3, 5]
+
+
+class FileSvnClient(object):
+    """svn.remote.RemoteClient stand-in serving last changed revision
+       and svn:mergeinfo of branch roots from local files
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.properties_calls = 0
+
+    def write(self, path, revision, mergeinfo):
+        os.makedirs(os.path.join(self.root, path), exist_ok=True)
+        with open(os.path.join(self.root, path, 'revision'), 'w') as f:
+            f.write(str(revision))
+        with open(os.path.join(self.root, path, 'mergeinfo'), 'w') as f:
+            f.write(mergeinfo)
+
+    def _read(self, path, name):
+        try:
+            with open(os.path.join(self.root, path, name)) as f:
+                return f.read()
+        except IOError:
+            raise svn.common.SvnException('path not found: {}'.format(path))
+
+    def info(self, path):
+        return {'commit_revision': int(self._read(path, 'revision'))}
+
+    def properties(self, path):
+        self.properties_calls += 1
+        return {'svn:mergeinfo': self._read(path, 'mergeinfo')}
+
+@pytest.mark.django_db()
+class TestSyncMergeinfo():
+
+    @pytest.fixture()
+    def branch(self, valid_user):
+        branch = Branch.create('STABLE-12', 'stable/12')
+        branch.branch_date = datetime.now()
+        branch.save()
+        for revision in range(1, 8):
+            commit = Commit.create('{:040x}'.format(revision), valid_user.username, datetime.now(), 'commit message')
+            commit.svn_revision = revision
+            commit.save()
+        return branch
+
+    @pytest.fixture()
+    def client(self):
+        path = tempfile.mkdtemp()
+        yield FileSvnClient(path)
+        shutil.rmtree(path)
+
+    def merged(self, branch):
+        return sorted(branch.merges.values_list('svn_revision', flat=True))
+
+    def test_missing_branch(self, branch, client):
+        git_only = Branch.create('STABLE-13', 'stable/13')
+        git_only.branch_date = datetime.now()
+        git_only.save()
+        client.write('stable/12', 100, '/head:1-3')
+        command = SyncSvnCommand(stdout=StringIO())
+        assert command.sync_branches(client, [git_only, branch], '/head') == ['STABLE-13']
+        assert self.merged(branch) == [1, 2, 3]
+
+    def test_sync(self, branch, client):
+        command = SyncSvnCommand()
+        client.write('stable/12', 100, '/head:1-3\n/stable/11:4')
+        assert command.sync_mergeinfo(client, branch, '/head') == 3
+        assert self.merged(branch) == [1, 2, 3]
+
+        # Branch root did not change
+        assert command.sync_mergeinfo(client, branch, '/head') == 0
+        assert client.properties_calls == 1
+
+        # Branch root changed but svn:mergeinfo did not
+        client.write('stable/12', 101, '/head:1-3\n/stable/11:4')
+        assert command.sync_mergeinfo(client, branch, '/head') == 0
+        assert client.properties_calls == 2
+
+        # Only new ranges are applied
+        Commit.objects.get(svn_revision=1).merged_to.remove(branch)
+        client.write('stable/12', 102, '/head:1-3,5-6\n/stable/11:4')
+        assert command.sync_mergeinfo(client, branch, '/head') == 2
+        assert self.merged(branch) == [2, 3, 5, 6]
+
+        assert command.sync_mergeinfo(client, branch, '/head', full=True) == 1
+        assert self.merged(branch) == [1, 2, 3, 5, 6]
+
+    def test_not_imported(self, branch, client):
+        command = SyncSvnCommand()
+        client.write('stable/12', 100, '/head:6-9')
+        assert command.sync_mergeinfo(client, branch, '/head') == 2
+        commit = Commit.create('{:040x}'.format(8), 'gonzo', datetime.now(), 'commit message')
+        commit.svn_revision = 8
+        commit.save()
+        assert command.sync_mergeinfo(client, branch, '/head') == 1
+        assert self.merged(branch) == [6, 7, 8]
+
+@pytest.mark.django_db()
+class TestKeysetPagination():
+
+    @pytest.fixture()
+    def commits(self, valid_user):
+        for counter in range(1, 8):
+            commit = Commit.create('{:040x}'.format(counter), valid_user.username, datetime.now(), 'commit message')
+            commit.commit_counter = counter
+            commit.save()
+            paths = ['sys/file{}'.format(counter), 'sys/dir/file{}'.format(counter)]
+            for path_id in Path.ids(paths).values():
+                Change(path_id=path_id, commit=commit).save()
+        return Commit.objects.all()
+
+    def counters(self, page):
+        return [commit.commit_counter for commit in page]
+
+    def test_pages(self, commits):
+        page = keyset_page(commits, 'commit_counter', 3)
+        assert self.counters(page) == [7, 6, 5]
+        assert page.has_next() and not page.has_previous()
+
+        page = keyset_page(commits, 'commit_counter', 3, after=page.next_cursor)
+        assert self.counters(page) == [4, 3, 2]
+        assert page.has_next() and page.has_previous()
+
+        page = keyset_page(commits, 'commit_counter', 3, after=page.next_cursor)
+        assert self.counters(page) == [1]
+        assert not page.has_next() and page.has_previous()
+
+        page = keyset_page(commits, 'commit_counter', 3, before=page.previous_cursor)
+        assert self.counters(page) == [4, 3, 2]
+        assert page.has_next() and page.has_previous()
+
+        page = keyset_page(commits, 'commit_counter', 3, before=page.previous_cursor)
+        assert self.counters(page) == [7, 6, 5]
+        assert page.has_next() and not page.has_previous()
+
+    def test_past_end(self, commits):
+        page = keyset_page(commits, 'commit_counter', 3, after=1)
+        assert self.counters(page) == [7, 6, 5]
+
+    def test_path_filter(self, commits):
+        filtered = commits.filter(parse_filters('@sys'))
+        assert filtered.count() == 7
+        page = keyset_page(filtered, 'commit_counter', 10)
+        assert self.counters(page) == [7, 6, 5, 4, 3, 2, 1]
+        filtered = commits.filter(parse_filters('gonzo@sys/file3 @/sys/dir/file5'))
+        assert sorted(filtered.values_list('commit_counter', flat=True)) == [3, 5]
+
+    def test_extended_filter(self, commits):
+        filtered = commits.filter(parse_extended_filters('sys/dir/file2\n\n/sys/file4\n'))
+        assert sorted(filtered.values_list('commit_counter', flat=True)) == [2, 4]
+        assert parse_extended_filters('\n \n') is None
+
+    def test_path_ids(self, commits):
+        ids = Path.ids(['sys/file1', 'sys/new'])
+        assert Path.objects.get(pk=ids['sys/file1']).path == 'sys/file1'
+        assert Path.objects.get(pk=ids['sys/new']).path == 'sys/new'
+        assert Path.ids(['sys/new']) == {'sys/new': ids['sys/new']}
+        assert Path.objects.count() == 15
+
+@pytest.mark.django_db()
+class TestCommitListQueries():
+    """Rendering commit list must not issue queries per row"""
+
+    @pytest.fixture()
+    def branches(self):
+        trunk = Branch.create('HEAD', 'main')
+        trunk.is_trunk = True
+        trunk.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        trunk.save()
+        stable = Branch.create('STABLE-13', 'stable/13')
+        stable.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        stable.save()
+        return trunk, stable
+
+    def add_commits(self, branches, user, first, last):
+        trunk, stable = branches
+        for counter in range(first, last):
+            commit = Commit.create('{:040x}'.format(counter), user.username, datetime.now(timezone.utc), 'commit message')
+            commit.commit_counter = counter
+            commit.branch = trunk
+            commit.mfc_after = date.today()
+            commit.save()
+            if counter % 2:
+                commit.merged_to.add(stable)
+            if counter % 3 == 0:
+                CommitNote.create(commit, user, 'note').save()
+            if counter % 5 == 0:
+                user.profile.do_not_merge.add(commit)
+        user.profile.add_to_basket(Commit.objects.values_list('sha', flat=True))
+
+    def count_queries(self, client, url):
+        cache.clear()
+        branch_registry.maintenance()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        assert response.status_code == 200
+        return len(context.captured_queries)
+
+    def urls(self, branches, user):
+        trunk, stable = branches
+        return [
+            reverse('branch', kwargs={'branch_id': stable.pk}) + '?after=',
+            reverse('mfcbasket', kwargs={'branch_id': stable.pk}),
+            reverse('mfcshare', kwargs={'branch_id': stable.pk, 'username': user.username, 'token': user.profile.share_token}),
+            reverse('never_mfc'),
+        ]
+
+    def test_fixed_query_count(self, loggedin_client, valid_user, branches):
+        self.add_commits(branches, valid_user, 1, 4)
+        small = [self.count_queries(loggedin_client, url) for url in self.urls(branches, valid_user)]
+        self.add_commits(branches, valid_user, 4, 16)
+        large = [self.count_queries(loggedin_client, url) for url in self.urls(branches, valid_user)]
+        assert small == large
+
+    def test_cursor_reset(self, client, valid_user, branches):
+        trunk, stable = branches
+        self.add_commits(branches, valid_user, 1, 21)
+        url = reverse('branch', kwargs={'branch_id': stable.pk})
+        def counters(response):
+            return [c.commit_counter for c in response.context['commits'].object_list]
+        assert counters(client.get(url + '?after=10')) == list(range(9, 0, -1))
+        assert counters(client.get(url)) == list(range(9, 0, -1))
+        client.post(reverse('setfilter', kwargs={'branch_id': stable.pk}), {'filters': valid_user.username})
+        assert counters(client.get(url)) == list(range(20, 5, -1))
+        client.get(url + '?after=10')
+        client.get(reverse('branch', kwargs={'branch_id': trunk.pk}))
+        assert counters(client.get(url)) == list(range(20, 5, -1))
+
+    def test_annotations(self, valid_user, branches):
+        trunk, stable = branches
+        self.add_commits(branches, valid_user, 1, 7)
+        with CaptureQueriesContext(connection) as context:
+            commits = annotate_commits(Commit.objects.order_by('commit_counter'), stable, valid_user)
+        assert len(context.captured_queries) == 4
+        assert [c.merged_to_branch for c in commits] == [True, False, True, False, True, False]
+        assert [c.user_note is not None for c in commits] == [False, False, True, False, False, True]
+        assert [c.user_banned for c in commits] == [False, False, False, False, True, False]
+
+@pytest.mark.django_db()
+class TestMfcStatus():
+
+    @pytest.fixture()
+    def branches(self, valid_user):
+        trunk = Branch.create('HEAD', 'main')
+        trunk.is_trunk = True
+        trunk.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        trunk.save()
+        stable = Branch.create('STABLE-13', 'stable/13')
+        stable.branch_date = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        stable.save()
+        mfc_after = [None, date(2021, 3, 1), date(2021, 3, 10), date(2021, 3, 1)]
+        for counter, mfc_date in enumerate(mfc_after, 1):
+            commit = Commit.create('{:040x}'.format(counter), valid_user.username, datetime(2021, 2, counter, tzinfo=timezone.utc), 'commit message')
+            commit.branch = trunk
+            commit.commit_counter = counter
+            commit.mfc_after = mfc_date
+            commit.save()
+        # Before the branch point
+        commit = Commit.create('{:040x}'.format(0), valid_user.username, datetime(2020, 6, 1, tzinfo=timezone.utc), 'commit message')
+        commit.branch = trunk
+        commit.save()
+        Commit.objects.get(commit_counter=4).merged_to.add(stable)
+        return trunk, stable
+
+    NO_DATE = MfcStatus.STATE_NO_DATE
+    READY = MfcStatus.STATE_READY
+    WAITING = MfcStatus.STATE_WAITING
+    DONE = MfcStatus.STATE_DONE
+
+    def states(self, branch):
+        return dict(branch.mfc_status.values_list('commit_counter', 'state'))
+
+    def test_refresh(self, branches):
+        trunk, stable = branches
+        assert refresh_status(stable, today=date(2021, 3, 5)) == 4
+        assert self.states(stable) == {1: self.NO_DATE, 2: self.READY, 3: self.WAITING, 4: self.DONE}
+
+        Commit.objects.get(commit_counter=2).merged_to.add(stable)
+        assert refresh_status(stable, ['{:040x}'.format(2)], today=date(2021, 3, 5)) == 1
+        assert self.states(stable) == {1: self.NO_DATE, 2: self.DONE, 3: self.WAITING, 4: self.DONE}
+
+    def test_trunk_commits(self, branches):
+        trunk, stable = branches
+        assert refresh_trunk_commits(['{:040x}'.format(i) for i in range(4)], today=date(2021, 3, 5)) == 3
+        assert self.states(stable) == {1: self.NO_DATE, 2: self.READY, 3: self.WAITING}
+
+    def test_advance(self, branches):
+        trunk, stable = branches
+        refresh_status(stable, today=date(2021, 2, 1))
+        assert self.states(stable) == {1: self.NO_DATE, 2: self.WAITING, 3: self.WAITING, 4: self.DONE}
+        assert advance_status(date(2021, 3, 5)) == 1
+        assert self.states(stable) == {1: self.NO_DATE, 2: self.READY, 3: self.WAITING, 4: self.DONE}
+        assert advance_status(date(2021, 3, 5)) == 0
+
+@pytest.mark.django_db()
+class TestMessageSearch():
+
+    @pytest.fixture()
+    def commits(self, valid_user):
+        messages = [
+            'Fix iwm firmware loading <again>\n\nMFC after: 1 week',
+            'iwm: add new device ids',
+            'Fixed panic in ZFS',
+        ]
+        writer = CommitWriter()
+        for counter, msg in enumerate(messages, 1):
+            commit = Commit.create('{:040x}'.format(counter), valid_user.username if counter < 3 else 'someone', datetime.now(), msg)
+            commit.commit_counter = counter
+            writer.add_commit(commit)
+        writer.flush()
+        return Commit.objects.all()
+
+    def counters(self, query):
+        return sorted(query.values_list('commit_counter', flat=True))
+
+    def test_filter(self, commits):
+        assert self.counters(commits.filter(parse_filters('msg:iwm'))) == [1, 2]
+        assert self.counters(commits.filter(parse_filters('msg:fixes'))) == [1, 3]
+        assert self.counters(commits.filter(parse_filters('msg:"iwm fixes"'))) == [1]
+        assert self.counters(commits.filter(parse_filters('msg:zfs, msg:device'))) == [2, 3]
+        assert self.counters(commits.filter(parse_filters('msg:fix someone'))) == [1, 3]
+        assert parse_filters('msg:') is None
+
+    def test_search_query(self):
+        assert search_query('gonzo r100') is None
+        assert search_query('gonzo msg:iwm') is not None
+
+    def test_headline(self, commits):
+        commits = annotate_search(list(commits.order_by('commit_counter')), search_query('msg:firmware'))
+        assert '<mark>firmware</mark>' in commits[0].search_headline
+        assert '&lt;again&gt;' in commits[0].search_headline
+        assert commits[0].search_rank > 0
+        assert '<mark>' not in commits[1].search_headline
+
+@pytest.mark.django_db()
+class TestMissingDependencies():
+
+    @pytest.fixture()
+    def commits(self, valid_user):
+        branch = Branch.create('STABLE-13', 'stable/13')
+        branch.branch_date = datetime.now()
+        branch.save()
+        commits = {}
+        for name in 'ABCDEFG':
+            sha = name.lower() * 40
+            commits[name] = Commit.create(sha, valid_user.username, datetime.now(), 'commit message')
+            commits[name].save()
+        # A - B - C - D(merged) - E, F - G
+        for a, b in ['AB', 'BC', 'CD', 'DE', 'FG']:
+            commits[a].mfc_with.add(commits[b])
+        commits['D'].merged_to.add(branch)
+        return branch, commits
+
+    def test_transitive(self, commits):
+        branch, commits = commits
+        with CaptureQueriesContext(connection) as context:
+            missing = missing_dependencies([commits['A'].sha], branch)
+        assert len(context.captured_queries) == 1
+        assert missing == {commits['A'].sha: {commits['B'].sha, commits['C'].sha}}
+
+    def test_in_set(self, commits):
+        branch, commits = commits
+        missing = missing_dependencies([commits['A'].sha, commits['B'].sha, commits['F'].sha, commits['G'].sha], branch)
+        # A depends on C through B, which reports it
+        assert missing == {commits['B'].sha: {commits['C'].sha}}
+
+    def test_empty(self, commits):
+        branch, commits = commits
+        assert missing_dependencies([], branch) == {}
+        assert missing_dependencies([commits['E'].sha], branch) == {}
+
+class TestDependencyGroups(TestCase):
+
+    def test_new_groups(self):
+        assign, renames = connected_components([('a', 'b'), ('b', 'c'), ('d', 'e')],
+            {'a': None, 'b': None, 'c': None, 'd': None, 'e': None}, 1)
+        assert assign == {'a': 1, 'b': 1, 'c': 1, 'd': 2, 'e': 2}
+        assert renames == {}
+
+    def test_merge_groups(self):
+        assign, renames = connected_components([('a', 'c'), ('c', 'e')], {'a': 3, 'c': 1, 'e': None}, 4)
+        assert assign == {'a': 1, 'e': 1}
+        assert renames == {3: 1}
+
+    def test_existing_group(self):
+        assign, renames = connected_components([('a', 'b')], {'a': 5, 'b': 5}, 6)
+        assert assign == {}
+        assert renames == {}
+
+@pytest.mark.django_db()
+class TestFixDependencies():
+
+    @pytest.fixture()
+    def commits(self, valid_user):
+        commits = {}
+        for day, name in enumerate('ABCDE', 1):
+            commits[name] = Commit.create(name.lower() * 40, valid_user.username, datetime(2021, 1, day, tzinfo=timezone.utc), 'commit message')
+            commits[name].save()
+        return commits
+
+    def groups(self):
+        return dict(Commit.objects.values_list('sha', 'dependency_group'))
+
+    def test_incremental(self, commits):
+        a, b, c, d, e = [commits[name].sha for name in 'ABCDE']
+        merge_dependency_groups([(a, b)])
+        merge_dependency_groups([(d, c)])
+        groups = self.groups()
+        assert groups[a] == groups[b]
+        assert groups[c] == groups[d]
+        assert groups[a] != groups[c]
+        assert groups[e] is None
+
+        merge_dependency_groups([(b, d)])
+        groups = self.groups()
+        assert groups[a] == groups[b] == groups[c] == groups[d]
+        assert groups[e] is None
+
+    def test_fix_dependencies(self, loggedin_client, valid_user, commits):
+        a, b, c, d, e = [commits[name].sha for name in 'ABCDE']
+        merge_dependency_groups([(d, b), (b, a), (a, e)])
+        valid_user.profile.add_to_basket([c, d])
+        response = loggedin_client.post(reverse('fixdeps_commit', kwargs={'sha': d}))
+        assert response.status_code == 204
+        assert valid_user.profile.mfc_basket == [c, d, a, b, e]
+
+@pytest.mark.django_db()
+class TestMfcCommitMessage():
+
+    @pytest.fixture()
+    def hashes(self, valid_user):
+        messages = [
+            ('gonzo', 'Fix build\n\nMFC after: 1 week\nReviewed by: someone\n'),
+            ('someone', 'Add feature\n\nLonger description.\nMFC after:\t3 days\n'),
+        ]
+        hashes = []
+        for day, (author, msg) in enumerate(messages, 1):
+            commit = Commit.create('{:040x}'.format(day), author, datetime(2021, 1, day, tzinfo=timezone.utc), msg)
+            commit.save()
+            hashes.append(commit.sha)
+        cache.clear()
+        return hashes
+
+    def test_full(self, valid_user, hashes):
+        assert mfc_commit_message(hashes, valid_user) == (
+            '00000000:\nFix build\n\nReviewed by: someone\n'
+            '\n\n'
+            '00000000 by someone:\nAdd feature\n\nLonger description.\n'
+            '\n'
+            '(cherry picked from commit {})\n'
+            '(cherry picked from commit {})\n'.format(*hashes))
+
+    def test_single(self, valid_user, hashes):
+        assert mfc_commit_message(hashes[:1], valid_user) == (
+            'Fix build\n\nReviewed by: someone\n'
+            '\n'
+            '(cherry picked from commit {})\n'.format(hashes[0]))
+
+    def test_summarized(self, valid_user, hashes):
+        assert mfc_commit_message(hashes, valid_user, summarized=True) == (
+            '\n00000000: Fix build'
+            '\n00000000: Add feature'
+            '\n\n'
+            '(cherry picked from commit {})\n'
+            '(cherry picked from commit {})\n'.format(*hashes))
+
+    def test_empty(self, valid_user):
+        assert mfc_commit_message([], valid_user) is None
+
+    def test_cached(self, valid_user, hashes):
+        full = mfc_commit_message(hashes, valid_user)
+        with CaptureQueriesContext(connection) as context:
+            assert mfc_commit_message(hashes, valid_user) == full
+            assert mfc_commit_message(hashes, valid_user, summarized=True).startswith('\n00000000: Fix build')
+        assert len(context.captured_queries) == 0
+
+@pytest.mark.django_db()
+class TestPageCache():
+
+    def test_generations(self, valid_user, commit):
+        cache.clear()
+        calls = []
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        assert cached('test', [1], compute, users=[valid_user]) == 1
+        assert cached('test', [1], compute, users=[valid_user]) == 1
+        assert cached('test', [2], compute, users=[valid_user]) == 2
+
+        invalidate_imports()
+        assert cached('test', [1], compute, users=[valid_user]) == 3
+
+        valid_user.profile.do_not_merge.add(commit)
+        assert cached('test', [1], compute, users=[valid_user]) == 4
+        commit.userprofile_set.remove(valid_user.profile)
+        assert cached('test', [1], compute, users=[valid_user]) == 5
+        CommitNote.create(commit, valid_user, 'text').save()
+        assert cached('test', [1], compute, users=[valid_user]) == 6
+        valid_user.profile.add_to_basket([commit.sha])
+        assert cached('test', [1], compute, users=[valid_user]) == 7
+
+        # Import generation is shared, user generations are not
+        other = User.objects.create_user(username='other', password='password', email='other@freebsd.org')
+        generation = user_generation(valid_user.pk)
+        CommitNote.create(commit, other, 'text').save()
+        assert user_generation(valid_user.pk) == generation
+
+    def test_never_mfc_page(self, loggedin_client, valid_user, commit):
+        cache.clear()
+        valid_user.profile.do_not_merge.add(commit)
+        url = reverse('never_mfc')
+        response = loggedin_client.get(url)
+        assert [c.sha for c in response.context['commits']] == [commit.sha]
+        with CaptureQueriesContext(connection) as context:
+            response = loggedin_client.get(url)
+        assert [c.sha for c in response.context['commits']] == [commit.sha]
+        assert response.context['commits'].paginator.num_pages == 1
+        assert not any('mfctracker_commit' in query['sql'] for query in context.captured_queries)
+
+    def test_branch_page(self, loggedin_client, valid_user):
+        cache.clear()
+        trunk = Branch.create('HEAD', 'main')
+        trunk.is_trunk = True
+        trunk.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        trunk.save()
+        commit = Commit.create('{:040x}'.format(1), valid_user.username, datetime.now(timezone.utc), 'commit message')
+        commit.branch = trunk
+        commit.commit_counter = 1
+        commit.save()
+        url = reverse('branch', kwargs={'branch_id': trunk.pk})
+
+        with CaptureQueriesContext(connection) as first:
+            response = loggedin_client.get(url)
+        assert b'note text' not in response.content
+        with CaptureQueriesContext(connection) as second:
+            response = loggedin_client.get(url)
+        assert len(second.captured_queries) < len(first.captured_queries)
+
+        CommitNote.create(commit, valid_user, 'note text').save()
+        response = loggedin_client.get(url)
+        assert b'note text' in response.content
+
+@pytest.mark.django_db()
+class TestBranchRegistry():
+
+    @pytest.fixture()
+    def branches(self):
+        trunk = Branch.create('HEAD', 'main')
+        trunk.is_trunk = True
+        trunk.branch_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        trunk.save()
+        for name, year in [('STABLE-12', 2018), ('STABLE-13', 2021), ('STABLE-11', 2016)]:
+            b = Branch.create(name, 'stable/' + name[-2:])
+            b.branch_date = datetime(year, 1, 1, tzinfo=timezone.utc)
+            b.save()
+        return trunk
+
+    def test_lookups(self, branches):
+        registry = BranchRegistry()
+        with CaptureQueriesContext(connection) as context:
+            assert registry.trunk().name == 'HEAD'
+            assert [b.name for b in registry.maintenance()] == ['STABLE-13', 'STABLE-12', 'STABLE-11']
+            assert registry.get(branches.pk).name == 'HEAD'
+            assert registry.get(str(branches.pk)).name == 'HEAD'
+            assert registry.get(0) is None
+            assert registry.get('x') is None
+        assert len(context.captured_queries) == 1
+
+    def test_local_invalidation(self, branches):
+        branch_registry.maintenance()
+        b = Branch.create('STABLE-14', 'stable/14')
+        b.branch_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        b.save()
+        assert branch_registry.maintenance()[0].name == 'STABLE-14'
+        b.delete()
+        assert branch_registry.maintenance()[0].name == 'STABLE-13'
+
+        # Importer checkpoints do not reload branches
+        branch_registry.maintenance()
+        branches.last_commit = 'abc'
+        branches.save(update_fields=['last_commit'])
+        with CaptureQueriesContext(connection) as context:
+            branch_registry.maintenance()
+        assert len(context.captured_queries) == 0
+
+    def test_other_process(self, branches):
+        registry = BranchRegistry(check_interval=0)
+        assert len(registry.maintenance()) == 3
+        # Signal handler only resets the global registry
+        b = Branch.create('STABLE-14', 'stable/14')
+        b.branch_date = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        b.save()
+        assert len(registry.maintenance()) == 4
+
+@pytest.mark.django_db()
+class TestBasket():
+
+    def test_order_and_duplicates(self, valid_user):
+        profile = valid_user.profile
+        profile.add_to_basket(['c', 'a', 'c'])
+        profile.add_to_basket(['b', 'a'])
+        assert profile.mfc_basket == ['c', 'a', 'b']
+        profile.remove_from_basket('a')
+        profile.remove_from_basket('missing')
+        assert profile.mfc_basket == ['c', 'b']
+        profile.clear_basket()
+        assert profile.mfc_basket == []
+
+    def test_api(self, loggedin_client, valid_user):
+        response = loggedin_client.post(reverse('addrevision'), {'sha': 'a'})
+        assert response.json() == {'basket': ['a']}
+        loggedin_client.post(reverse('addrevision'), {'sha': 'b'})
+        response = loggedin_client.post(reverse('addrevision'), {'sha': 'a'})
+        assert response.json() == {'basket': ['a', 'b']}
+        response = loggedin_client.post(reverse('delrevision'), {'sha': 'a'})
+        assert response.json() == {'basket': ['b']}
+        assert valid_user.profile.mfc_basket == ['b']
+        response = loggedin_client.post(reverse('clearbasket'))
+        assert response.json() == {'basket': []}
+        assert valid_user.profile.mfc_basket == []
+
+    def test_anonymous(self, client):
+        client.post(reverse('addrevision'), {'sha': 'a'})
+        response = client.post(reverse('addrevision'), {'sha': 'a'})
+        assert response.json() == {'basket': ['a']}
+        response = client.post(reverse('delrevision'), {'sha': 'a'})
+        assert response.json() == {'basket': []}
@@ -0,0 +1,72 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.utils.crypto import get_random_string
+
+from mfctracker.models import UserProfile
+
+def provision_users(usernames):
+    """Make sure every committer in usernames has user account and profile.
+
+       Missing users are created in bulk with unusable passwords, so no
+       password hashing is involved, and profiles are bulk-created for
+       every user that does not have one yet since bulk_create does not
+       send post_save. Returns sorted list of created usernames.
+    """
+    usernames = set(username for username in usernames if username)
+    if not usernames:
+        return []
+
+    known = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+    created = sorted(usernames - known)
+    users = []
+    for username in created:
+        email = '{}@{}'.format(username, settings.SVN_EMAIL_DOMAIN)
+        users.append(User(username=username, email=email, password=make_password(None)))
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+    except IntegrityError:
+        # Concurrent import created some of them
+        created = []
+        for user in users:
+            defaults = {'email': user.email, 'password': user.password}
+            _, was_created = User.objects.get_or_create(username=user.username, defaults=defaults)
+            if was_created:
+                created.append(user.username)
+
+    no_profile = User.objects.filter(username__in=usernames, profile__isnull=True).values_list('pk', flat=True)
+    profiles = [UserProfile(user_id=pk, share_token=get_random_string(length=8)) for pk in no_profile]
+    try:
+        with transaction.atomic():
+            UserProfile.objects.bulk_create(profiles)
+    except IntegrityError:
+        for profile in profiles:
+            UserProfile.objects.get_or_create(user_id=profile.user_id,
+                defaults={'share_token': profile.share_token})
+
+    return created
@@ -22,41 +22,259 @@
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
 import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from itertools import islice
 
-def get_mfc_requirements(msg):
-    """ Get set of revisions required to be merged with commit """
-    requirements = set()
-    lines = msg.split('\n')
-    for line in lines:
-        if re.match('^\s*(x-)?mfc(-|\s+)with\s*:', line, flags=re.IGNORECASE):
-            pos = line.find(':')
-            line = line[pos+1:]
-            revisions = re.split('[, ]+', line.strip())
-            for rev in revisions:
+import parsedatetime
+
+SVN_REVISION_RE = re.compile(r'.*revision=(\d+).*')
+
+# All trailers mfctracker cares about, matched in one pass over the message
+TRAILERS_RE = re.compile(
+    r'^[ \t]*(?:(?P<mfc_after>mfc(?:-|[ \t]+)after)|(?P<mfc_with>(?:x-)?mfc(?:-|[ \t]+)with))[ \t]*:(?P<value>.*)$'
+    r'|\(cherry picked from commit (?P<cherry_picked>[0-9a-f]+)\)',
+    flags=re.IGNORECASE | re.MULTILINE)
+REQUIREMENTS_SPLIT_RE = re.compile(r'[, ]+')
+
+# Reference times with different time of day, month lengths and leap
+# days around them, used to tell plain durations from anything else
+MFC_AFTER_REFERENCES = (
+    datetime(2000, 1, 31, 3, 0, tzinfo=timezone.utc),
+    datetime(2001, 1, 31, 3, 0, tzinfo=timezone.utc),
+    datetime(2001, 3, 15, 21, 0, tzinfo=timezone.utc),
+)
+
+CommitMetadata = namedtuple('CommitMetadata', ['mfc_after', 'mfc_with', 'cherry_picked', 'svn_revision', 'errors'])
+
+def get_svn_revision(notes):
+    """ Get SVN revision number recorded in git notes or None """
+    m = SVN_REVISION_RE.match(notes)
+    if m:
+        return int(m.group(1))
+    return None
+
+_calendars = threading.local()
+
+def _parse_date(line, source_date):
+    # Calendar is expensive to create and keeps parse context, so
+    # there is one per thread
+    calendar = getattr(_calendars, 'calendar', None)
+    if calendar is None:
+        calendar = _calendars.calendar = parsedatetime.Calendar()
+    st, parsed = calendar.parse(line, source_date)
+    if not parsed:
+        return None
+    return date.fromtimestamp(time.mktime(st))
+
+@lru_cache(maxsize=1024)
+def _mfc_after_offset(line):
+    """Parse MFC after line once. Returns tuple (parsed, offset), offset
+       is timedelta to add to commit date if the line is a plain duration
+       like "2 weeks" or None if it has to be parsed for every commit
+       (absolute dates, months, etc...)
+    """
+    offsets = set()
+    for reference in MFC_AFTER_REFERENCES:
+        parsed = _parse_date(line, reference)
+        if parsed is None:
+            return False, None
+        offsets.add(parsed - reference.date())
+    if len(offsets) == 1:
+        return True, offsets.pop()
+    return True, None
+
+def parse_mfc_after(line, commit_date):
+    """ Get date after which commit can be merged or None """
+    parsed, offset = _mfc_after_offset(line)
+    if not parsed:
+        return None
+    if offset is None:
+        return _parse_date(line, commit_date)
+    return commit_date.date() + offset
+
+def parse_commit_metadata(msg, commit_date=None, notes=None):
+    """ Extract MFC after date, X-MFC-With requirements, cherry-picked
+        commits and SVN revision (from git notes) in one pass over the
+        commit message. MFC after date is computed only if commit_date
+        is passed.
+    """
+    mfc_after = None
+    mfc_with = set()
+    cherry_picked = set()
+    errors = []
+
+    for m in TRAILERS_RE.finditer(msg):
+        if m.group('cherry_picked'):
+            cherry_picked.add(m.group('cherry_picked'))
+        elif m.group('mfc_with'):
+            for rev in REQUIREMENTS_SPLIT_RE.split(m.group('value').strip()):
                 if rev.startswith('r'):
                     rev = rev[1:]
-                requirements.add(rev)
+                if rev:
+                    mfc_with.add(rev)
+        elif mfc_after is None and commit_date is not None:
+            line = m.group(0)
+            mfc_after = parse_mfc_after(line, commit_date)
+            if mfc_after is None:
+                errors.append(u'Failed to parse MFC line: \'' + line + u'\'')
+
+    svn_revision = None
+    if notes is not None:
+        svn_revision = get_svn_revision(notes)
 
-    return requirements
+    return CommitMetadata(mfc_after, mfc_with, cherry_picked, svn_revision, errors)
+
+def get_mfc_requirements(msg):
+    """ Get set of revisions required to be merged with commit """
+    return parse_commit_metadata(msg).mfc_with
 
 def get_cherry_picked_commits(msg):
     """ Get set of commits that were cherrypicked for this commit"""
-    picks = set()
-    lines = msg.split('\n')
-    for line in lines:
-        m = re.match('.*\(cherry picked from commit ([0-9a-f]+)\).*', line, flags=re.IGNORECASE)
-        if m:
-            sha = m.group(1)
-            picks.add(sha)
+    return parse_commit_metadata(msg).cherry_picked
+
+
+class IntervalSet(object):
+    """Set of integers (SVN revisions) stored as sorted list of
+       non-overlapping closed intervals. Overlapping and adjacent
+       intervals are merged, so memory use depends on the number
+       of gaps and not on the number of revisions.
+    """
 
-    return picks
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        for first, last in sorted(intervals):
+            if first > last:
+                raise ValueError('Invalid interval: {}-{}'.format(first, last))
+            if self._ends and first <= self._ends[-1] + 1:
+                if last > self._ends[-1]:
+                    self._ends[-1] = last
+            else:
+                self._starts.append(first)
+                self._ends.append(last)
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Create interval set from mix of numbers and (first, last) tuples"""
+        return cls((r, r) if type(r) == int else r for r in ranges)
+
+    @classmethod
+    def from_string(cls, ranges_str):
+        """Create interval set from svn:mergeinfo style list of ranges,
+           e.g. "1-3,5,7-9*". Non-inheritable ranges are marked with *
+        """
+        intervals = []
+        for r in ranges_str.split(','):
+            r = r.strip().rstrip('*')
+            if not r:
+                continue
+            if r.find('-') > 0:
+                start, stop = r.split('-')
+                intervals.append((int(start), int(stop),))
+            else:
+                intervals.append((int(r), int(r),))
+        return cls(intervals)
+
+    def add(self, first, last=None):
+        """Add interval first-last or single number first"""
+        if last is None:
+            last = first
+        if first > last:
+            raise ValueError('Invalid interval: {}-{}'.format(first, last))
+        # Intervals that overlap or touch the new one are replaced
+        lo = bisect_left(self._ends, first - 1)
+        hi = bisect_right(self._starts, last + 1)
+        if lo < hi:
+            first = min(first, self._starts[lo])
+            last = max(last, self._ends[hi - 1])
+        self._starts[lo:hi] = [first]
+        self._ends[lo:hi] = [last]
+
+    def __contains__(self, n):
+        i = bisect_right(self._starts, n) - 1
+        return i >= 0 and n <= self._ends[i]
+
+    def __iter__(self):
+        """Iterate over (first, last) intervals"""
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        """Number of intervals"""
+        return len(self._starts)
+
+    def __bool__(self):
+        return len(self._starts) > 0
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __repr__(self):
+        return 'IntervalSet({!r})'.format(list(self))
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in self)
+
+    def count(self):
+        """Number of integers in the set"""
+        return sum(last - first + 1 for first, last in self)
+
+    def union(self, other):
+        return IntervalSet(list(self) + list(other))
+
+    def difference(self, other):
+        """Intervals of self that are not covered by other"""
+        result = []
+        other = list(other)
+        j = 0
+        for first, last in self:
+            while j < len(other) and other[j][1] < first:
+                j += 1
+            k = j
+            while k < len(other) and other[k][0] <= last:
+                if other[k][0] > first:
+                    result.append((first, other[k][0] - 1))
+                first = max(first, other[k][1] + 1)
+                k += 1
+            if first <= last:
+                result.append((first, last))
+        return IntervalSet(result)
+
+    __or__ = union
+    __sub__ = difference
+
+    def gaps(self, first=None, last=None):
+        """Iterate over (first, last) intervals that are missing from the
+           set between first and last, by default between set's own bounds
+        """
+        if not self._starts:
+            if first is not None and last is not None and first <= last:
+                yield (first, last)
+            return
+        if first is None:
+            first = self._starts[0]
+        if last is None:
+            last = self._ends[-1]
+        for start, end in self:
+            if start > last:
+                break
+            if start > first:
+                yield (first, min(start - 1, last))
+            first = max(first, end + 1)
+        if first <= last:
+            yield (first, last)
 
 
 def parse_mergeinfo_prop(mergeinfo_str):
     """Parse svn:mergeinfo property and return dictionary
-       where branch pathes are keys and values are compact
-       representations of merged commits: array of numbers
-       and tuples with <first, last> values
+       where branch pathes are keys and values are IntervalSet
+       objects with merged revisions
     """
 
     lines = mergeinfo_str.split('\n')
@@ -64,19 +282,9 @@ def parse_mergeinfo_prop(mergeinfo_str):
 
     for  line in lines:
         if not line:
-            next
-        branch_path, merged_part = line.split(':')
-        revisions = merged_part.split(',')
-        merged = []
-        for r in revisions:
-            if r.find('-') > 0:
-                start, stop = r.split('-')
-                merged.append((int(start), int(stop),))
-            else:
-                if r.endswith('*'):
-                    r = r[:-1]
-                merged.append(int(r))
-        mergeinfo[branch_path] = merged
+            continue
+        branch_path, merged_part = line.rsplit(':', 1)
+        mergeinfo[branch_path] = IntervalSet.from_string(merged_part)
 
     return mergeinfo
 
@@ -91,3 +299,11 @@ def mergeinfo_ranges_to_set(mergeinfo_ranges):
             result |= set(range(r[0], r[1]+1))
     return result
 
+def batches(iterable, size):
+    """Split iterable into lists of at most size elements"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
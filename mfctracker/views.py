@@ -21,23 +21,43 @@
 #  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 #  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 #  SUCH DAMAGE.
-from datetime import date
+import hashlib
 import re
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
-from django.db.models import Q
+from django.db.models import F, Func, Q, TextField, Value
 from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest
 from django.shortcuts import redirect, get_object_or_404
 from django.template import loader
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.utils.crypto import get_random_string
 from django.views.decorators.http import require_POST, require_http_methods
 
-from .models import Branch, Commit, CommitNote
+from .dependencies import missing_dependencies
+from .models import SEARCH_CONFIG, Change, Commit, CommitNote, MfcStatus, Path, UserProfile
+from .pagecache import cached, import_generation
+from .pagination import cached_count, keyset_page
+from .registry import branch_registry, get_branch_or_404
+
+COMMITS_PER_PAGE = 15
+MFC_MESSAGE_CACHE_TIMEOUT = 24 * 3600
+
+MFC_AFTER_RE = re.compile('^MFC(-|\\s+)after:.*\n?', re.IGNORECASE | re.MULTILINE)
+
+# Filter tokens are separated by spaces or commas, message search
+# terms can be quoted: msg:"some words"
+FILTER_TOKEN_RE = re.compile(r'msg:"[^"]*"?|[^\s,]+')
+# Highlighted words in headline are wrapped in control characters so
+# message can be HTML-escaped before they are replaced with tags
+HEADLINE_OPTIONS = 'StartSel=\x02, StopSel=\x03, MaxFragments=2, MaxWords=25, MinWords=10'
 
 def svn_range_to_arg(start, end):
     if start == end:
@@ -45,28 +65,110 @@ def svn_range_to_arg(start, end):
     else:
         return '-r {}:{}'.format(start - 1, end)
 
-def parse_extended_filters(trunk_path, filters):
+def path_filter(*paths):
+    """Match commits that changed anything under any of paths. Prefixes
+       are range scans over Path dictionary, changes are looked up by
+       integer path id. Semi-join subquery instead of join on changes
+       so every commit is returned once and no DISTINCT is required
+    """
+    q = Q()
+    for path in paths:
+        # Paths in repository are relative to its root
+        q |= Q(path__startswith=path.lstrip('/'))
+    changes = Change.objects.filter(path__in=Path.objects.filter(q))
+    return Q(pk__in=changes.values('commit_id'))
+
+def parse_cursor(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def annotate_commits(commits, branch=None, user=None):
+    """Attach per-row state used by commit list template tags: merged
+       flag for the branch, user's note and "never MFC" flag. One query
+       per kind of state for the whole list instead of one per row.
+       Returns list of commits.
+    """
+    commits = list(commits)
+    shas = [commit.sha for commit in commits]
+
+    merged = set()
+    if branch is not None and shas:
+        merged = set(Commit.merged_to.through.objects.filter(
+            branch_id=branch.pk, commit_id__in=shas).values_list('commit_id', flat=True))
+
+    notes = {}
+    banned = set()
+    if user is not None and user.is_authenticated() and shas:
+        notes = {note.commit_id: note for note in CommitNote.objects.filter(user=user, commit_id__in=shas)}
+        banned = set(UserProfile.do_not_merge.through.objects.filter(
+            userprofile__user=user, commit_id__in=shas).values_list('commit_id', flat=True))
+
+    for commit in commits:
+        commit.merged_to_branch = commit.sha in merged
+        commit.user_note = notes.get(commit.sha, None)
+        commit.user_banned = commit.sha in banned
+
+    return commits
+
+def parse_extended_filters(filters):
+    """One path per line, matches commits under any of them"""
+    paths = [s.strip() for s in filters.split('\n')]
+    paths = [s for s in paths if s]
+    if not paths:
+        return None
+    return path_filter(*paths)
+
+def search_term(s):
+    """Text of msg: filter token or None for other filters"""
+    if not s.startswith('msg:'):
+        return None
+    return s[4:].strip('"').strip()
+
+def search_query(filters):
+    """Combined SearchQuery of all msg: terms in filters or None"""
     result = None
-    for s in filters.split('\n'):
-        s = s.strip()
-        if not s:
+    for s in FILTER_TOKEN_RE.findall(filters):
+        term = search_term(s)
+        if not term:
             continue
-        if not s.startswith('/'):
-            s = '/' + s
-        path = trunk_path + s
-        q = Q(changes__path__startswith=path)
+        query = SearchQuery(term, config=SEARCH_CONFIG)
         if result is None:
-            result = q
+            result = query
         else:
-            result = result | q
+            result = result | query
     return result
 
+def annotate_search(commits, query):
+    """Attach relevance rank and message headline with highlighted
+       search terms to commits, one query for the whole list
+    """
+    shas = [commit.sha for commit in commits]
+    headline = Func(Value(SEARCH_CONFIG), F('msg'), query, Value(HEADLINE_OPTIONS),
+        function='ts_headline', output_field=TextField())
+    rows = Commit.objects.filter(sha__in=shas).annotate(
+        rank=SearchRank(F('msg_search'), query), headline=headline).values_list('sha', 'rank', 'headline')
+    matches = {sha: (rank, headline) for sha, rank, headline in rows}
+    for commit in commits:
+        rank, headline = matches.get(commit.sha, (None, ''))
+        commit.search_rank = rank
+        headline = escape(headline).replace('\x02', '<mark>').replace('\x03', '</mark>')
+        commit.search_headline = mark_safe(headline)
+    return commits
+
 def parse_single_filter(s):
     committer = ''
     path = ''
     committer_q = None
     path_q = None
 
+    term = search_term(s)
+    if term is not None:
+        if not term:
+            return None
+        return Q(msg_search=SearchQuery(term, config=SEARCH_CONFIG))
+
     m = re.match('^r(\d+)(?:-r(\d+))?$', s)
 
     if m:
@@ -93,7 +195,7 @@ def parse_single_filter(s):
         committer_q = Q(author=committer)
 
     if path:
-        path_q = Q(changes__path__startswith=path)
+        path_q = path_filter(path)
     if path_q and committer_q:
         q = path_q & committer_q
     elif path_q:
@@ -104,12 +206,10 @@ def parse_single_filter(s):
 
 def parse_filters(filters):
     result = None
-    pattern = re.compile("[\s,]+")
-    for s in pattern.split(filters):
-        s = s.strip()
-        if not s:
-            continue
+    for s in FILTER_TOKEN_RE.findall(filters):
         q = parse_single_filter(s)
+        if q is None:
+            continue
         if result is None:
             result = q
         else:
@@ -119,56 +219,63 @@ def parse_filters(filters):
 
 def parse_x_mfc_with_alerts(commits, current_branch):
     alerts = {}
-    # XXX: fixme
     hashes = [commit.sha for commit in commits]
-    for commit in commits:
-        # Remove ^MFC.*after:.*$
-        msg = commit.msg
-        mfc_with = set(commit.mfc_with.all().values_list('sha', flat=True))
-        merged = set(current_branch.merges.filter(sha__in=mfc_with).values_list('sha', flat=True))
-        missing = mfc_with - set(hashes) - merged
-        if len(missing) > 0:
-            missing_list = ', '.join([x[:12] for x in missing])
-            plural = 'commits are' if len(missing) > 1 else 'commit is'
-            alerts[commit.sha] = 'Following {} marked as X-MFC-With by {}: {}'.format(plural, commit.sha, missing_list)
+    for sha, missing in missing_dependencies(hashes, current_branch).items():
+        missing_list = ', '.join([x[:12] for x in sorted(missing)])
+        plural = 'commits are' if len(missing) > 1 else 'commit is'
+        alerts[sha] = 'Following {} marked as X-MFC-With by {}: {}'.format(plural, sha, missing_list)
     return alerts
 
-def mfc_commit_message(hashes, user, summarized=False):
-    commits = Commit.objects.filter(sha__in=hashes).order_by("date")
-    commit_msg = None
-    if len(hashes) > 0:
-        commit_msg = ''
-        mfc_re = re.compile('^MFC(-|\s+)after:.*\n?', re.IGNORECASE | re.MULTILINE)
-        for commit in commits:
-            if summarized:
-                commit_msg = commit_msg + '\n' + commit.sha_abbr + ': '
-                msg = commit.msg.strip()
-                lines = msg.split('\n')
-                if len(lines) > 0:
-                    # Add summary string 
-                    commit_msg = commit_msg + lines[0]
-            else:
-                if len(hashes) > 1:
-                    if commit_msg:
-                        commit_msg += '\n'
-                    commit_msg = commit_msg + '\n' + str(commit.sha_abbr)
-                    if not user.is_anonymous():
-                        if user.username != commit.author:
-                            commit_msg += ' by {}'.format(commit.author)
-                    commit_msg += ':'
-                # Remove ^MFC.*after:.*$
-                msg = commit.msg
-                msg = mfc_re.sub('', msg)
-                commit_msg = commit_msg + '\n' + msg
-                commit_msg = commit_msg.strip() + '\n'
-
-    commit_msg += '\n'
-    if summarized:
-        commit_msg += '\n'
+def build_mfc_commit_messages(commits, count, user):
+    """Build full and summarized MFC commit messages for commits in date
+       order in one pass. count is the number of requested commits, full
+       message has per-commit headers if it is greater than one.
+       Returns tuple (full, summarized).
+    """
+    full = []
+    summary = []
+    trailer = []
+    username = None if user.is_anonymous() else user.username
     for commit in commits:
-        commit_msg += f'(cherry picked from commit {commit.sha})\n'
+        msg = commit.msg.strip()
+        eol = msg.find('\n')
+        summary.append('\n{}: {}'.format(commit.sha_abbr, msg if eol < 0 else msg[:eol]))
+
+        msg = MFC_AFTER_RE.sub('', commit.msg)
+        if count > 1:
+            header = str(commit.sha_abbr)
+            if username is not None and username != commit.author:
+                header += ' by {}'.format(commit.author)
+            part = '{}:\n{}'.format(header, msg).rstrip()
+            if full:
+                part = '\n\n' + part
+        else:
+            part = msg.strip()
+        full.append(part + '\n')
 
-    return commit_msg
+        trailer.append('(cherry picked from commit {})\n'.format(commit.sha))
+
+    trailer = ''.join(trailer)
+    return ''.join(full) + '\n' + trailer, ''.join(summary) + '\n\n' + trailer
+
+def mfc_commit_message(hashes, user, summarized=False):
+    """MFC commit message for commits in hashes, which are expected to be
+       in date order. Both formats are cached by the list of SHAs and
+       the user, commits never change once imported.
+    """
+    if len(hashes) == 0:
+        return None
+
+    key = '\0'.join([user.get_username()] + list(hashes))
+    cache_key = 'mfctracker:mfcmsg:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+    messages = cache.get(cache_key)
+    if messages is None:
+        commits = Commit.objects.filter(sha__in=hashes).order_by("date")
+        messages = build_mfc_commit_messages(commits, len(hashes), user)
+        cache.set(cache_key, messages, MFC_MESSAGE_CACHE_TIMEOUT)
+
+    full, summary = messages
+    return summary if summarized else full
 
 def _get_basket(request):
     if request.user.is_authenticated():
@@ -177,17 +284,33 @@ def _get_basket(request):
         basket = request.session.get('basket', [])
     return basket
 
-def _set_basket(request, basket):
+def _add_to_basket(request, shas):
     if request.user.is_authenticated():
-        request.user.profile.mfc_basket = basket
-        request.user.profile.save()
+        request.user.profile.add_to_basket(shas)
     else:
+        basket = request.session.get('basket', [])
+        basket.extend(sha for sha in shas if not sha in basket)
         request.session['basket'] = basket
 
+def _remove_from_basket(request, sha):
+    if request.user.is_authenticated():
+        request.user.profile.remove_from_basket(sha)
+    else:
+        basket = request.session.get('basket', [])
+        if sha in basket:
+            basket.remove(sha)
+        request.session['basket'] = basket
+
+def _clear_basket(request):
+    if request.user.is_authenticated():
+        request.user.profile.clear_basket()
+    else:
+        request.session['basket'] = []
+
 def index(request):
     default_pk = request.session.get('branch', None)
     if default_pk is None:
-        branches = Branch.maintenance().order_by('-branch_date', '-name')
+        branches = branch_registry.maintenance()
         default_pk = branches[0].pk
     return redirect('branch', branch_id=default_pk)
 
@@ -196,89 +319,115 @@ def setfilter(request, branch_id):
     filter_waiting = request.POST.get('filter_waiting', None)
     filter_ready = request.POST.get('filter_ready', None)
     filter_other = request.POST.get('filter_other', None)
-    # extended_filters = request.POST.get('extended_filters', None)
+    extended_filters = request.POST.get('extended_filters', None)
 
     request.session['filters'] = filters
     request.session['filter_waiting'] = filter_waiting is not None
     request.session['filter_ready'] = filter_ready is not None
     request.session['filter_other'] = filter_other is not None
-    # request.session['extended_filters'] = extended_filters
+    request.session['extended_filters'] = extended_filters
+    # Position in old result list means nothing for the new one
+    request.session.pop('cursor', None)
 
     return redirect('branch', branch_id=branch_id)
 
 def branch(request, branch_id):
-    current_branch = get_object_or_404(Branch, pk=branch_id)
+    current_branch = get_branch_or_404(branch_id)
     request.session['branch'] = branch_id
 
     template = loader.get_template('mfctracker/index.html')
-    trunk = Branch.trunk()
+    trunk = branch_registry.trunk()
     query = trunk.commits.filter(date__gt=current_branch.branch_date)
+    commits_filtered = False
     if not request.user.is_anonymous():
        query = query.exclude(userprofile=request.user.profile)
+       commits_filtered = True
 
     filters = request.session.get('filters', None)
     filter_waiting = request.session.get('filter_waiting', False)
     filter_ready = request.session.get('filter_ready', False)
     filter_other = request.session.get('filter_other', False)
-    # extended_filters = request.session.get('extended_filters', '')
+    extended_filters = request.session.get('extended_filters', None)
 
-    # if extended_filters:
-    #     q = q & parse_extended_filters(trunk.path, extended_filters)
+    if extended_filters:
+        extended_q = parse_extended_filters(extended_filters)
+        if extended_q:
+            query = query.filter(extended_q)
+            commits_filtered = True
+    else:
+        extended_filters = ''
 
     if filters:
         parsed_q = parse_filters(filters)
         if parsed_q:
             query = query.filter(parsed_q)
+            commits_filtered = True
     else:
         filters = ''
 
-    q = Q()
+    states = []
 
     if filter_ready:
-        q  = q | Q(mfc_after__lte=date.today())
+        states.append(MfcStatus.STATE_READY)
 
     if filter_waiting:
-        q = q | Q(mfc_after__gt=date.today())
+        states.append(MfcStatus.STATE_WAITING)
 
     if filter_other:
-        q = q | Q(mfc_after__isnull=True)
-
-    if filter_waiting or filter_ready or filter_other:
-       q = q & ~Q(merged_to__pk__contains=current_branch.pk)
-
-    # if extended_filters:
-    #     q = q & parse_extended_filters(trunk.path, extended_filters)
-    query = query.filter(q)
-
-    # Hack to properly simulate inner join and get rid of extra
-    # rows caused by the changes join
-    all_commits = query.order_by('-commit_counter').distinct('commit_counter')
-    paginator = Paginator(all_commits, 15)
-
-    page = request.GET.get('page')
-    if page is None:
-        page = request.session.get('page', None)
-    if page is None:
-        page = 1
-
-    try:
-        page = int(page)
-    except ValueError:
-        page = 1
-
-    try:
-        commits = paginator.page(int(page))
-        request.session['page'] = page
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        commits = paginator.page(paginator.num_pages)
-        request.session['page'] = paginator.num_pages
+        states.append(MfcStatus.STATE_NO_DATE)
+
+    if states:
+        # Walk (branch, state, commit_counter) index of the status table
+        # instead of anti-joining merged_to, commit filters are applied
+        # as semi-join
+        status_query = current_branch.mfc_status.filter(state__in=states)
+        if commits_filtered:
+            status_query = status_query.filter(commit__in=query)
+        query = status_query.select_related('commit')
+
+    # Saved cursor is only valid for the same branch and filters
+    cursor_scope = [current_branch.pk, filters, extended_filters, sorted(states)]
+    if 'after' in request.GET or 'before' in request.GET:
+        cursor = {
+            'after': parse_cursor(request.GET.get('after')),
+            'before': parse_cursor(request.GET.get('before')),
+            'scope': cursor_scope,
+        }
+        request.session['cursor'] = cursor
+    else:
+        cursor = request.session.get('cursor', {})
+        if cursor.get('scope') != cursor_scope:
+            cursor = {}
+            request.session.pop('cursor', None)
+
+    def branch_page():
+        commits = keyset_page(query, 'commit_counter', COMMITS_PER_PAGE,
+            after=cursor.get('after'), before=cursor.get('before'))
+        if states:
+            commits.object_list = [row.commit for row in commits.object_list]
+        commits.object_list = annotate_commits(commits.object_list, current_branch, request.user)
+        search = search_query(filters)
+        if search is not None:
+            annotate_search(commits.object_list, search)
+        # Total is shared by all pages of the same query
+        commits.count = cached_count(query, version=import_generation())
+        return commits
+
+    cache_parts = [
+        current_branch.pk,
+        ' '.join(FILTER_TOKEN_RE.findall(filters)),
+        sorted(set(s.strip() for s in extended_filters.split('\n') if s.strip())),
+        sorted(states),
+        cursor.get('after'),
+        cursor.get('before'),
+    ]
+    commits = cached('branch', cache_parts, branch_page, users=[request.user])
 
     context = {}
     context['commits'] = commits
     context['current_branch'] = current_branch
     context['filters'] = filters
-    # context['extended_filters'] = extended_filters
+    context['extended_filters'] = extended_filters
 
     if filter_waiting:
         context['waiting_checked'] = 'checked'
@@ -296,12 +445,12 @@ def branch(request, branch_id):
 
 
 def mfcbasket(request, branch_id):
-    current_branch = get_object_or_404(Branch, pk=branch_id)
-    trunk_branch = Branch.trunk()
+    current_branch = get_branch_or_404(branch_id)
     template = loader.get_template('mfctracker/mfcbasket.html')
     sha_hashes = _get_basket(request)
     print (sha_hashes)
-    commits = Commit.objects.filter(sha__in=sha_hashes).order_by("-date")
+    commits = annotate_commits(Commit.objects.filter(sha__in=sha_hashes).order_by("-date"),
+        current_branch, request.user)
     if request.user.is_authenticated:
         share_uri = reverse('mfcshare', kwargs={
             'username': request.user.username,
@@ -321,12 +470,13 @@ def mfcbasket(request, branch_id):
 
 
 def mfcshare(request, branch_id, username, token):
-    current_branch = get_object_or_404(Branch, pk=branch_id)
-    trunk_branch = Branch.trunk()
+    current_branch = get_branch_or_404(branch_id)
     user = get_object_or_404(User, username=username, profile__share_token=token)
     template = loader.get_template('mfctracker/mfcshare.html')
     sha_hashes = user.profile.mfc_basket
-    commits = Commit.objects.filter(sha__in=sha_hashes).order_by("-date")
+    commits = cached('mfcshare', [current_branch.pk],
+        lambda: annotate_commits(Commit.objects.filter(sha__in=sha_hashes).order_by("-date"), current_branch, request.user),
+        users=[user, request.user])
     context = {}
     context['commits'] = commits
     context['username'] = username
@@ -335,8 +485,7 @@ def mfcshare(request, branch_id, username, token):
 
 def mfchelper(request, branch_id, summarized = False):
     request.session['summarized'] = summarized
-    current_branch = get_object_or_404(Branch, pk=branch_id)
-    trunk_branch = Branch.trunk()
+    current_branch = get_branch_or_404(branch_id)
     template = loader.get_template('mfctracker/mfc.html')
     sha_hashes = _get_basket(request)
     commits = Commit.objects.filter(sha__in=sha_hashes).order_by("date")
@@ -376,36 +525,29 @@ def basket(request):
 
 @require_POST
 def addrevision(request):
-    current_basket = _get_basket(request)
     sha = request.POST.get('sha', None)
     if not sha:
         return HttpResponseBadRequest()
 
-    if not sha in current_basket:
-        current_basket.append(sha)
-    _set_basket(request, current_basket)
+    _add_to_basket(request, [sha])
 
-    return JsonResponse({'basket': current_basket})
+    return JsonResponse({'basket': _get_basket(request)})
 
 @require_POST
 def delrevision(request):
-    current_basket = _get_basket(request)
     sha = request.POST.get('sha', None)
     if not sha:
         return HttpResponseBadRequest()
 
-    if sha in current_basket:
-        current_basket.remove(sha)
-    _set_basket(request, current_basket)
+    _remove_from_basket(request, sha)
 
-    return JsonResponse({'basket': current_basket})
+    return JsonResponse({'basket': _get_basket(request)})
 
 @require_POST
 def clearbasket(request):
-    current_basket = []
-    _set_basket(request, current_basket)
+    _clear_basket(request)
 
-    return JsonResponse({'basket': current_basket})
+    return JsonResponse({'basket': []})
 
 @require_http_methods(["POST", "DELETE"])
 def comment_commit(request, sha):
@@ -434,14 +576,17 @@ def comment_commit(request, sha):
 @require_http_methods(["POST"])
 def fix_commit_dependencies(request, sha):
     commit = get_object_or_404(Commit, sha=sha)
-    mfc_with = set(commit.mfc_with.all().values_list('sha', flat=True))
-    current_basket = _get_basket(request)
+    if commit.dependency_group is None:
+        return HttpResponse(status=204)
 
-    for dependency in mfc_with:
-        if not dependency in current_basket:
-            current_basket.append(dependency)
+    # Whole X-MFC-With closure in one query, without commits that are
+    # already merged to the branch being viewed
+    dependencies = Commit.objects.filter(dependency_group=commit.dependency_group)
+    branch_id = request.session.get('branch', None)
+    if branch_id is not None:
+        dependencies = dependencies.exclude(merged_to__pk=branch_id)
 
-    _set_basket(request, current_basket)
+    _add_to_basket(request, dependencies.order_by('date').values_list('sha', flat=True))
 
     return HttpResponse(status=204)
 
@@ -504,17 +649,27 @@ def never_mfc(request):
     template = loader.get_template('mfctracker/nevermfc.html')
 
     all_commits = request.user.profile.do_not_merge.order_by("-date")
-    paginator = Paginator(all_commits, 15)
-
     page = request.GET.get('page')
-    try:
-        commits = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        commits = paginator.page(1)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        commits = paginator.page(paginator.num_pages)
+
+    def never_mfc_page():
+        paginator = Paginator(all_commits, 15)
+        try:
+            commits = paginator.page(page)
+        except PageNotAnInteger:
+            # If page is not an integer, deliver first page.
+            commits = paginator.page(1)
+        except EmptyPage:
+            # If page is out of range (e.g. 9999), deliver last page of results.
+            commits = paginator.page(paginator.num_pages)
+        object_list = annotate_commits(commits.object_list, user=request.user)
+        return object_list, paginator.count, commits.number
+
+    object_list, count, number = cached('never_mfc', [page], never_mfc_page, users=[request.user])
+    # Rebuild the page around cached rows without COUNT and page queries
+    paginator = Paginator(all_commits, 15)
+    paginator.count = count
+    commits = paginator.page(number)
+    commits.object_list = object_list
 
     context = {}
     context['commits'] = commits
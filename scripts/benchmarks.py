@@ -0,0 +1,155 @@
+#  Copyright (c) 2016-2019 Oleksandr Tymoshenko <gonzo@bluezbox.com>
+#  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#  IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#  ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+#  FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+#  DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+#  OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+#  HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+#  LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+#  OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+#  SUCH DAMAGE.
+"""Micro-benchmarks for mfctracker helpers that do not need database.
+
+Run from the top of the source tree: python scripts/benchmarks.py
+"""
+import os
+import random
+import re
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import date, datetime, timezone
+
+import parsedatetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mfctracker.utils import mergeinfo_ranges_to_set, parse_commit_metadata, parse_mergeinfo_prop
+
+COMMIT_DATE = datetime(2021, 3, 14, 21, 30, tzinfo=timezone.utc)
+
+MESSAGES = [
+    """iwm: Fix a race in the firmware loading path
+
+The firmware may be loaded twice if the interface is brought up while
+the previous attempt is still in progress.  Serialize the loads.
+
+PR:		253851
+Reviewed by:	markj
+MFC after:	2 weeks
+Sponsored by:	The FreeBSD Foundation
+Differential Revision:	https://reviews.freebsd.org/D29021
+""",
+    """Regen after r368070
+""",
+    """MFC r368070, r368085:
+
+linux(4): handle AT_EMPTY_PATH in faccessat
+
+(cherry picked from commit 9f3a9b4f5e7d4e8a1b2c3d4e5f60718293a4b5c6)
+(cherry picked from commit 1a2b3c4d5e6f708192a3b4c5d6e7f8091a2b3c4d)
+""",
+    """arm64: Add the missing barriers to atomic_fcmpset
+
+Reported by:	kevans
+X-MFC-With:	r368112, 4b2c1d0e
+MFC after:	3 days
+""",
+    """Vendor import of llvm-project main llvmorg-12-init-17869-g8e464dd76be
+
+MFC after:	1 month
+""",
+]
+
+CORPUS = MESSAGES * 200
+
+
+def legacy_metadata(msg, commit_date):
+    """Line by line parsing the way importcommits used to do it"""
+    mfc_after = None
+    for line in msg.split('\n'):
+        if re.match('^\\s*mfc(-|\\s+)after\\s*:', line, flags=re.IGNORECASE):
+            calendar = parsedatetime.Calendar()
+            st, parsed = calendar.parse(line, commit_date)
+            if parsed:
+                mfc_after = date.fromtimestamp(time.mktime(st))
+                break
+    requirements = set()
+    for line in msg.split('\n'):
+        if re.match('^\\s*(x-)?mfc(-|\\s+)with\\s*:', line, flags=re.IGNORECASE):
+            line = line[line.find(':')+1:]
+            for rev in re.split('[, ]+', line.strip()):
+                requirements.add(rev[1:] if rev.startswith('r') else rev)
+    picks = set()
+    for line in msg.split('\n'):
+        m = re.match('.*\\(cherry picked from commit ([0-9a-f]+)\\).*', line, flags=re.IGNORECASE)
+        if m:
+            picks.add(m.group(1))
+    return mfc_after, requirements, picks
+
+
+def make_mergeinfo(revisions=400000, ranges=20000, seed=12):
+    """svn:mergeinfo of the FreeBSD stable branch scale"""
+    rnd = random.Random(seed)
+    bounds = sorted(rnd.sample(range(1, revisions), ranges * 2))
+    parts = []
+    for i in range(0, len(bounds), 2):
+        first, last = bounds[i], bounds[i + 1]
+        parts.append(str(first) if rnd.random() < 0.3 else '{}-{}'.format(first, last))
+    return '/head:{}\n/stable/11:1-1000\n'.format(','.join(parts))
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench(name, func, number=5):
+    best = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('{:<40} {:>10.2f} ms'.format(name, best * 1000))
+
+
+def bench_commit_metadata():
+    print('Commit metadata, {} messages'.format(len(CORPUS)))
+    bench('legacy per-line parsing', lambda: [legacy_metadata(msg, COMMIT_DATE) for msg in CORPUS])
+    bench('parse_commit_metadata', lambda: [parse_commit_metadata(msg, COMMIT_DATE) for msg in CORPUS])
+
+
+def bench_mergeinfo():
+    prop = make_mergeinfo()
+    mergeinfo = parse_mergeinfo_prop(prop)
+    print('svn:mergeinfo, {} ranges, {} revisions'.format(len(mergeinfo['/head']), mergeinfo['/head'].count()))
+    bench('parse_mergeinfo_prop', lambda: parse_mergeinfo_prop(prop), number=1)
+    bench('expand to set', lambda: mergeinfo_ranges_to_set(mergeinfo['/head']), number=1)
+    bench('membership, 100000 lookups', lambda: [n in mergeinfo['/head'] for n in range(0, 400000, 4)], number=1)
+    for name, func in (
+            ('IntervalSet peak memory', lambda: parse_mergeinfo_prop(prop)),
+            ('set peak memory', lambda: mergeinfo_ranges_to_set(parse_mergeinfo_prop(prop)['/head']))):
+        print('{:<40} {:>10.2f} MB'.format(name, peak_memory(func) / 1024.0 / 1024.0))
+    # The interval set does not grow with width of the ranges
+    wide = '/head:1-{}\n'
+    for width in (10 ** 4, 10 ** 6, 10 ** 8):
+        print('{:<40} {:>10} B'.format('one range of {} revisions'.format(width),
+            peak_memory(lambda: parse_mergeinfo_prop(wide.format(width)))))
+
+
+if __name__ == '__main__':
+    bench_commit_metadata()
+    bench_mergeinfo()